@@ -2,11 +2,14 @@ import os
 import openai
 from typing import List
 import time
-import requests
-import base64
 import dropbox
 import streamlit as st
 import environment as env
+import _imagery as img
+import _llm as llm
+from _uploads import upload_and_share, image_urls, thumbnail_urls
+from _thumbnails import with_thumbnails
+import database as db
 import random
 
 
@@ -15,14 +18,6 @@ env.load_env_variables()
 openai.api_key = env.get_api_key("OPENAI_API_KEY")
 
 
-# Stable.ai Keys
-api_host = os.getenv("API_HOST", "https://api.stability.ai")
-url = f"{api_host}/v1/user/account"
-api_key = env.get_api_key("STABILITY_API_KEY")
-if api_key is None:
-    raise Exception("Missing Stability API key.")
-
-
 # Dropbox Keys
 APP_KEY = env.get_api_key("APP_KEY")
 APP_SECRET = env.get_api_key("APP_SECRET")
@@ -34,11 +29,6 @@ dbx = dropbox.Dropbox(
 )
 
 
-# Looping parameters for errorr handling
-MAX_ATTEMPTS = 2
-DELAY_SECONDS = 10
-
-
 def read_file_contents():
     try:
         # List all files and folders in the /books folder of Dropbox
@@ -67,25 +57,23 @@ def read_file_contents():
 all_images = read_file_contents()
 
 
-def get_image_prompt(user_input):
+def get_image_prompt(user_input, bypass_cache=False):
     st.info("Creating prompt for the images...")
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+    response = llm.chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": """
             As a seasoned artist and photographer, you possess extensive expertise and skill honed over the years. Your journey has been filled with invaluable experiences, where you've embraced failures as valuable lessons and triumphed in your pursuit of capturing breathtaking visuals. 
             """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Generate a short, under 400 characters long, written textual representation of an art piece from this user input: {user_input}",
-                    },
-                    {
-                        "role": "assistant",
-                        "content": """
+            },
+            {
+                "role": "user",
+                "content": f"Generate a short, under 400 characters long, written textual representation of an art piece from this user input: {user_input}",
+            },
+            {
+                "role": "assistant",
+                "content": """
             Generate a short written textual, max 400 characters long, representation of the art piece that captures the essence, mood, and theme of the user input. Incorporate key terms extracted from the provided. Consider a suitable color scheme that aligns with the intended atmosphere. Use evocative language to describe visuals that reflect the plot, themes, or significant elements of the input. The output should not contain any images, only a textual representation of an art piece. Avoid any apologies or examples. 
 
             Here are 10 great examples of textual representation of art pieces that you can learn from:
@@ -112,20 +100,12 @@ def get_image_prompt(user_input):
 
             Please bear in mind that the aforementioned illustrations serve as a reference and a source of inspiration. It is crucial to employ artistic and photographic vocabulary in crafting a distinct and customized textual depiction FROM THE USER INPUT. Under 400 charachters long.
             """,
-                    },
-                ],
-                model="gpt-3.5-turbo",
-            )
-
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+            },
+        ],
+        model="gpt-3.5-turbo",
+        cache=True,
+        bypass_cache=bypass_cache,
+    )
 
     image_prompt = response["choices"][0]["message"]["content"]
 
@@ -133,83 +113,31 @@ def get_image_prompt(user_input):
     return image_prompt
 
 
-def create_dalle_image(prompt, samples, dalle_num=True):
-    if dalle_num and samples != 0:
-        st.info("Drawing DALL-E image...")
-        for attempt in range(1, MAX_ATTEMPTS + 1):
-            try:
-                dalle_data = openai.Image.create(
-                    prompt=prompt,
-                    n=samples,
-                    size="512x512",
-                    response_format="b64_json",  # Get image data instead of url
-                )
-                # If the code execution is successful, break out of the loop
-                break
-            except Exception as e:
-                # Handle RateLimitError
-                st.error(
-                    f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-                )
-            # Wait for the specified delay before the next attempt
-            time.sleep(DELAY_SECONDS)
-
-        # Return url instead of b64_json
-        # image_url = image_response["data"][0]["url"]
-
-        st.success("DALL-E image created!")
-        return dalle_data
-    else:
+def show_result(result, name):
+    # Report one provider's outcome and hand back its raw response
+    if result is None:
+        return None
+    if not result.ok:
+        st.error(
+            f"{name} failed after {result.attempts} attempts. Error message: {result.error}"
+        )
         return None
 
+    st.success(f"{name} image created in {result.latency:.1f}s!")
+    return result.data
 
-def create_stable_image(prompt, width, height, engine_id, samples, steps):
-    if samples != 0:
-        st.info("Drawing Stable image...")
-        for attempt in range(1, MAX_ATTEMPTS + 1):
-            try:
-                response = requests.post(
-                    f"{api_host}/v1/generation/{engine_id}/text-to-image",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Accept": "application/json",
-                        "Authorization": f"Bearer {api_key}",
-                    },
-                    json={
-                        "text_prompts": [{"text": f"{prompt}"}],
-                        "cfg_scale": 7,
-                        "clip_guidance_preset": "FAST_BLUE",
-                        "height": height,
-                        "width": width,
-                        "samples": samples,
-                        "steps": steps,
-                    },
-                )
-
-                if response.status_code != 200:
-                    stable_data = "No stability book"
-                    st.error("Stable not in a drawing mood today")
-                    raise Exception("Non-200 response: " + str(response.text))
-                else:
-                    stable_data = response.json()
-
-                # If the code execution is successful, break out of the loop
-                break
-            except Exception as e:
-                # Handle the specific exception (if known) or catch all exceptions
-                st.error(
-                    f"Attempt {attempt} failed. {e} Waiting a bit and trying again..."
-                )
-
-            # Wait for the specified delay before the next attempt
-            time.sleep(DELAY_SECONDS)
-
-        st.success("Stable image created!")
-
-        return stable_data
-
-    else:
-        return None
+
+def create_images(prompt, width, height, engine_id, samples, steps, dalle_num=True):
+    if samples == 0:
+        return None, None
+
+    st.info("Drawing DALL-E and Stable images...")
+    results = img.generate_images(
+        prompt, width, height, engine_id, samples, steps, dalle_num
+    )
+    dalle_data = show_result(results.get("dalle"), "DALL-E")
+    stable_data = show_result(results.get("stability"), "Stable")
+    return dalle_data, stable_data
 
 
 def save_all(
@@ -252,31 +180,56 @@ def save_all(
         # Save image prompt to txt file
         art_path = f"{folder_path}/{image_name}.txt"
         data_to_txt = f"**User input:** {user_input}\n\n**AI Generated prompt:** {image_prompt}\n\n**Stable Diffusion:** {engine} {width}x{height}\n\n**DALL-E:** 512x512\n\n **Negative prompt:** {neg_prompt}"
-        dbx.files_upload(data_to_txt.encode("utf-8"), art_path)
 
-        if dalle_num and dalle_data:
-            # Save DALL-E images to png
-            for i, image in enumerate(dalle_data["data"]):
-                timestamp = int(time.time())  # Get the current timestamp
-                random_number = random.randint(
-                    1000, 9999
-                )  # Generate a random 4-digit number
-                image_path = f"{folder_path}/{image_name}_dalle_{timestamp}_{random_number}_{i}.png"
-                image_data = base64.b64decode(image["b64_json"])
-                dbx.files_upload(image_data, image_path)
-                dalle_arts.append(image_data)
+        def files():
+            # Images are decoded one at a time while the previous ones upload
+            yield art_path, data_to_txt.encode("utf-8")
+
+            if dalle_num:
+                # Save DALL-E images to png
+                for i, image_data in enumerate(img.drain_images("dalle", dalle_data)):
+                    timestamp = int(time.time())  # Get the current timestamp
+                    random_number = random.randint(
+                        1000, 9999
+                    )  # Generate a random 4-digit number
+                    image_path = f"{folder_path}/{image_name}_dalle_{timestamp}_{random_number}_{i}.png"
+                    yield image_path, image_data
 
-        if stability_data:
             # Save Stability images to png
-            for i, image in enumerate(stability_data["artifacts"]):
+            for i, image_data in enumerate(
+                img.drain_images("stability", stability_data)
+            ):
                 timestamp = int(time.time())  # Get the current timestamp
                 random_number = random.randint(
                     1000, 9999
                 )  # Generate a random 4-digit number
                 image_path = f"{folder_path}/{image_name}_stability_{timestamp}_{random_number}_{i}.png"
-                image_data = base64.b64decode(image["base64"])
-                dbx.files_upload(image_data, image_path)
-                stable_arts.append(image_data)
+                yield image_path, image_data
+
+        manifest = upload_and_share(dbx, with_thumbnails(files()))
+        for upload in manifest:
+            if not upload.ok:
+                st.error(f"Could not upload {upload.path} to Dropbox: {upload.error}")
+
+        dalle_arts = image_urls(manifest, "dalle")
+        stable_arts = image_urls(manifest, "stability")
+
+        # Add the new image urls to the ones earlier generations of this art saved
+        art = db.get_art(image_name) or {}
+        art_urls = art.get("img_url") or []
+        art_thumbs = art.get("thumb_url") or []
+        if len(art_thumbs) != len(art_urls):
+            art_thumbs = art_urls
+
+        # Save prompt and image urls to database
+        st.sidebar.info("Saving to database")
+        db.insert_art(
+            image_name,
+            data_to_txt,
+            art_urls + image_urls(manifest),
+            art_thumbs + thumbnail_urls(manifest),
+        )
+        st.sidebar.success("Database updated!")
 
     except Exception as e:
         # Handle the specific exception (if known) or catch all exceptions
@@ -294,8 +247,9 @@ def art_generator(art_input, art_name, width, height, engine, samples, steps):
         st.session_state.art_expander = ""
 
     art_prompt = get_image_prompt(art_input)
-    dalle_art = create_dalle_image(art_prompt, samples)
-    stable_art = create_stable_image(art_prompt, width, height, engine, samples, steps)
+    dalle_art, stable_art = create_images(
+        art_prompt, width, height, engine, samples, steps
+    )
 
     st.session_state.dalle_art, st.session_state.stable_art = save_all(
         art_name,
@@ -312,12 +266,12 @@ def art_generator(art_input, art_name, width, height, engine, samples, steps):
     st.session_state.art_expander = st.expander(art_name, expanded=True)
     with st.session_state.art_expander:
         # Display DALL-E images
-        for image_data in st.session_state.dalle_art:
-            st.image(image_data)
+        for image_url in st.session_state.dalle_art:
+            st.image(image_url)
 
         # Display stability images
-        for image_data in st.session_state.stable_art:
-            st.image(image_data)
+        for image_url in st.session_state.stable_art:
+            st.image(image_url)
 
         st.title(art_name)
         st.write(art_input)
@@ -351,29 +305,44 @@ def save_chapter_img(
                 # Unexpected error, raise it
                 raise e
 
-        # Save DALL-E images to png
-        if dalle_num:
-            for i, image in enumerate(dalle_data["data"]):
-                timestamp = int(time.time())  # Get the current timestamp
-                random_number = random.randint(
-                    1000, 9999
-                )  # Generate a random 4-digit number
-                image_path = f"{folder_path}/{chapter_name}_dalle_{timestamp}_{random_number}.png"
-                image_data = base64.b64decode(image["b64_json"])
-                dbx.files_upload(image_data, image_path)
-                dalle_arts.append(image_data)
-
-        # Save Stability images to png
-        if stability_data:
-            for i, image in enumerate(stability_data["artifacts"]):
+        def files():
+            # Images are decoded one at a time while the previous ones upload
+            if dalle_num:
+                # Save DALL-E images to png
+                for image_data in img.drain_images("dalle", dalle_data):
+                    timestamp = int(time.time())  # Get the current timestamp
+                    random_number = random.randint(
+                        1000, 9999
+                    )  # Generate a random 4-digit number
+                    image_path = f"{folder_path}/{chapter_name}_dalle_{timestamp}_{random_number}.png"
+                    yield image_path, image_data
+
+            # Save Stability images to png
+            for image_data in img.drain_images("stability", stability_data):
                 timestamp = int(time.time())  # Get the current timestamp
                 random_number = random.randint(
                     1000, 9999
                 )  # Generate a random 4-digit number
                 image_path = f"{folder_path}/{chapter_name}_stability_{timestamp}_{random_number}.png"
-                image_data = base64.b64decode(image["base64"])
-                dbx.files_upload(image_data, image_path)
-                stable_arts.append(image_data)
+                yield image_path, image_data
+
+        manifest = upload_and_share(dbx, with_thumbnails(files()))
+        for upload in manifest:
+            if not upload.ok:
+                st.error(f"Could not upload {upload.path} to Dropbox: {upload.error}")
+
+        dalle_arts = image_urls(manifest, "dalle")
+        stable_arts = image_urls(manifest, "stability")
+
+        # Add the new image urls to the ones the chapter already has
+        chapter_urls = db.get_chapter_art(ebook_title, chapter_name) or []
+        chapter_thumbs = db.get_chapter_thumbs(ebook_title, chapter_name)
+        db.insert_ebook_art(
+            ebook_title,
+            chapter_name,
+            chapter_urls + image_urls(manifest),
+            chapter_thumbs + thumbnail_urls(manifest),
+        )
 
     except Exception as e:
         # Handle the specific exception (if known) or catch all exceptions
@@ -382,44 +351,34 @@ def save_chapter_img(
     return dalle_arts, stable_arts
 
 
-def get_negative_prompt(pos_prompt):
+def get_negative_prompt(pos_prompt, bypass_cache=False):
     st.info("Creating negative prompt for the images...")
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+    response = llm.chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": """
             As a seasoned artist and photographer, you possess extensive expertise and skill honed over the years. Your journey has been filled with invaluable experiences, where you've embraced failures as valuable lessons and triumphed in your pursuit of capturing breathtaking visuals. 
             """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"From the negative list provided, choose words that would be visually negative and unfitting to this textual representation: {pos_prompt}",
-                    },
-                    {
-                        "role": "assistant",
-                        "content": """
+            },
+            {
+                "role": "user",
+                "content": f"From the negative list provided, choose words that would be visually negative and unfitting to this textual representation: {pos_prompt}",
+            },
+            {
+                "role": "assistant",
+                "content": """
                         Choose words from the negative list that would make give textual representation visullay ugly. Output should contain only list of words, seperated with comma. Avoid any apologies or compliments.
 
                         negative list:
                         Ugly, Disfigured, Deformed, Low quality, Pixelated, Blurry, Grains, Text, Watermark, Signature, Out of frame, Disproportioned, Bad proportions, Gross, proportions, Bad anatomy, Duplicate, Cropped, Extra hands, Extra arms, Extra legs, Extra fingers, Extra limbs, Long neck, Mutation, Mutilated, Mutated  Hands, Poorly drawn face, Poorly drawn hands, Missing hands, Missing arms, Missing legs, Missing fingers, Low resolution, Morbid
             """,
-                    },
-                ],
-                model="gpt-3.5-turbo",
-            )
-
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+            },
+        ],
+        model="gpt-3.5-turbo",
+        cache=True,
+        bypass_cache=bypass_cache,
+    )
 
     image_prompt = response["choices"][0]["message"]["content"]
 
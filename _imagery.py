@@ -0,0 +1,170 @@
+import time
+import base64
+import asyncio
+import threading
+from collections import deque
+from dataclasses import dataclass
+import openai
+import environment as env
+import _retry as retry
+import _limiter as limit
+import _stability as stability
+
+
+# Openai Keys
+env.load_env_variables()
+openai.api_key = env.get_api_key("OPENAI_API_KEY")
+
+
+# Requests in flight per provider, shared by every session of the process
+MAX_IN_FLIGHT = {"dalle": 2, "stability": 4}
+
+# Number of recent call latencies kept per provider
+LATENCY_HISTORY = 100
+
+# Where each provider response keeps its images and the base64 field of one image
+PAYLOADS = {"dalle": ("data", "b64_json"), "stability": ("artifacts", "base64")}
+
+
+@dataclass
+class ImageResult:
+    provider: str
+    data: dict = None
+    error: Exception = None
+    attempts: int = 0
+    queued: float = 0.0  # Seconds spent waiting for a free provider slot
+    latency: float = 0.0  # Seconds from the first request to the final answer
+
+    @property
+    def ok(self):
+        return self.error is None and self.data is not None
+
+
+latencies = {provider: deque(maxlen=LATENCY_HISTORY) for provider in MAX_IN_FLIGHT}
+
+_loop = None
+_loop_lock = threading.Lock()
+_semaphores = {}
+
+
+def drain_images(provider, data):
+    # Decode the images of a response one at a time, each base64 payload is
+    # dropped from the response as soon as it has been decoded
+    if not data:
+        return
+    key, field = PAYLOADS[provider]
+    images = data[key]
+    images.reverse()
+    while images:
+        yield base64.b64decode(images.pop()[field])
+
+
+def get_loop():
+    # A single event loop thread carries the generations of every session
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="image-engine", daemon=True
+            ).start()
+    return _loop
+
+
+def run(coro, timeout=None):
+    # Block the calling script thread until the coroutine is done on the engine loop
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+
+def latency_stats():
+    stats = {}
+    for provider, history in latencies.items():
+        samples = sorted(history)
+        if samples:
+            stats[provider] = {
+                "calls": len(samples),
+                "p50": samples[len(samples) // 2],
+                "max": samples[-1],
+            }
+    return stats
+
+
+def _semaphore(provider):
+    # Only ever called on the engine loop, so no locking is needed
+    if provider not in _semaphores:
+        _semaphores[provider] = asyncio.Semaphore(MAX_IN_FLIGHT[provider])
+    return _semaphores[provider]
+
+
+async def _call(provider, request):
+    result = ImageResult(provider)
+
+    def count_retry(attempt, error, delay):
+        result.attempts = attempt
+
+    queued_at = time.perf_counter()
+    async with _semaphore(provider):
+        started_at = time.perf_counter()
+        result.queued = started_at - queued_at
+        try:
+            result.data = await retry.acall(request, on_retry=count_retry)
+        except Exception as e:
+            result.error = e
+        result.attempts += 1
+        result.latency = time.perf_counter() - started_at
+
+    latencies[provider].append(result.latency)
+    return result
+
+
+async def dalle(prompt, samples, size="512x512"):
+    async def request():
+        # Every generated picture counts against the shared images limit
+        await limit.get_limiter("images").aacquire(requests=samples)
+        return await openai.Image.acreate(
+            prompt=prompt,
+            n=samples,
+            size=size,
+            response_format="b64_json",  # Get image data instead of url
+        )
+
+    return await _call("dalle", request)
+
+
+async def stable(prompt, width, height, engine_id, samples, steps):
+    async def request():
+        # The pooled session is blocking, so the post runs on the loop's executor
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            stability.text_to_image,
+            prompt,
+            width,
+            height,
+            engine_id,
+            samples,
+            steps,
+        )
+
+    return await _call("stability", request)
+
+
+async def generate(prompt, width, height, engine_id, samples, steps, dalle_num=True):
+    # Providers run side by side and each result carries its own error
+    jobs = []
+    if dalle_num and samples != 0:
+        jobs.append(dalle(prompt, samples))
+    if samples != 0:
+        jobs.append(stable(prompt, width, height, engine_id, samples, steps))
+
+    results = await asyncio.gather(*jobs)
+    return {result.provider: result for result in results}
+
+
+def generate_images(
+    prompt, width, height, engine_id, samples, steps, dalle_num=True, timeout=None
+):
+    return run(
+        generate(prompt, width, height, engine_id, samples, steps, dalle_num),
+        timeout,
+    )
@@ -0,0 +1,102 @@
+import time
+import asyncio
+import threading
+
+
+# Requests and tokens per minute allowed for each model on our OpenAI key,
+# images are counted per generated picture instead of tokens
+LIMITS = {
+    "gpt-3.5-turbo": {"requests": 3500, "tokens": 90000},
+    "gpt-3.5-turbo-16k": {"requests": 3500, "tokens": 180000},
+    "images": {"requests": 50, "tokens": None},
+}
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+# Completion budget assumed when the caller does not set max_tokens
+COMPLETION_TOKENS = {"gpt-3.5-turbo": 1000, "gpt-3.5-turbo-16k": 4000}
+
+
+class TokenBucket:
+    def __init__(self, capacity, per_seconds=60):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        # Take the tokens right away, going into debt if needed, and return how
+        # long the caller has to wait for the debt to be paid back. Later callers
+        # inherit the debt, so waiting callers are served in arrival order.
+        with self.lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def refund(self, amount):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ModelLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, tokens=0, requests=1):
+        wait = self.requests.reserve(requests)
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    def acquire(self, tokens=0, requests=1):
+        wait = self.reserve(tokens, requests)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens=0, requests=1):
+        wait = self.reserve(tokens, requests)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def release(self, tokens):
+        # Give back the whole reservation of an attempt that failed
+        if self.tokens is not None and tokens:
+            self.tokens.refund(tokens)
+
+    def settle(self, estimated, actual):
+        # Give back what the estimate over-reserved, or take what it missed
+        if self.tokens is not None and actual is not None:
+            self.tokens.refund(estimated - actual)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model):
+    if model not in LIMITS:
+        model = DEFAULT_MODEL
+    with _limiters_lock:
+        if model not in _limiters:
+            limits = LIMITS[model]
+            _limiters[model] = ModelLimiter(limits["requests"], limits["tokens"])
+    return _limiters[model]
+
+
+def estimate_tokens(messages, model, max_tokens=None):
+    # Roughly four characters per token plus a few tokens of framing per message
+    prompt = sum(len(message["content"]) // 4 + 4 for message in messages)
+    if max_tokens is None:
+        max_tokens = COMPLETION_TOKENS.get(model, COMPLETION_TOKENS[DEFAULT_MODEL])
+    return prompt + max_tokens
@@ -0,0 +1,104 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import dropbox
+from _local_cache import CACHE_DIR
+
+
+# Path to shared URL memo, kept across restarts
+LINKS_PATH = os.path.join(CACHE_DIR, "shared_links.json")
+
+# Shared links created at the same time
+MAX_WORKERS = 8
+
+
+_memo = None
+_memo_lock = threading.Lock()
+
+
+def direct_url(url):
+    # Modify the shared link URL to force file download
+    return url.replace("www.dropbox.com", "dl.dropboxusercontent.com").split("?")[0]
+
+
+def _load():
+    global _memo
+    if _memo is None:
+        _memo = {}
+        if os.path.isfile(LINKS_PATH):
+            with open(LINKS_PATH, encoding="utf-8") as f:
+                _memo = json.load(f)
+    return _memo
+
+
+def _save():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temporary = f"{LINKS_PATH}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(_memo, f)
+    os.replace(temporary, LINKS_PATH)
+
+
+def _prime(dbx):
+    # First run without a memo: one paginated pass over the links that already
+    # exist, so we don't try to create them one by one
+    result = dbx.sharing_list_shared_links()
+    while True:
+        for link in result.links:
+            if link.path_lower:
+                _memo[link.path_lower] = direct_url(link.url)
+        if not result.has_more:
+            break
+        result = dbx.sharing_list_shared_links(cursor=result.cursor)
+
+
+def _create(dbx, path):
+    try:
+        link = dbx.sharing_create_shared_link_with_settings(
+            path,
+            dropbox.sharing.SharedLinkSettings(
+                requested_visibility=dropbox.sharing.RequestedVisibility.public
+            ),
+        )
+    except dropbox.exceptions.ApiError as e:
+        if not e.error.is_shared_link_already_exists():
+            raise e
+        # The error usually carries the existing link, otherwise ask for it
+        existing = e.error.get_shared_link_already_exists()
+        if existing is not None and existing.is_metadata():
+            link = existing.get_metadata()
+        else:
+            link = dbx.sharing_list_shared_links(path, direct_only=True).links[0]
+    return direct_url(link.url)
+
+
+def resolve(dbx, paths):
+    # Returns {path: url} for every path that could be shared and {path: error}
+    # for the rest. Known paths come from the memo, missing ones are created
+    # concurrently on a bounded pool.
+    with _memo_lock:
+        memo = _load()
+        if not memo and paths:
+            _prime(dbx)
+            _save()
+        urls = {path: memo[path.lower()] for path in paths if path.lower() in memo}
+
+    missing = [path for path in paths if path not in urls]
+    errors = {}
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(missing))) as executor:
+            futures = {path: executor.submit(_create, dbx, path) for path in missing}
+        for path, future in futures.items():
+            try:
+                urls[path] = future.result()
+            except Exception as e:
+                errors[path] = e
+
+        with _memo_lock:
+            for path in missing:
+                if path in urls:
+                    _memo[path.lower()] = urls[path]
+            _save()
+
+    return urls, errors
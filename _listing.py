@@ -0,0 +1,170 @@
+import os
+import re
+import hashlib
+from collections import namedtuple
+from _local_cache import CACHE_DIR, connect
+
+
+# Local mirrors of the Dropbox folders we sync, one database per synced root
+LISTING_DIR = os.path.join(CACHE_DIR, "dropbox")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS entries (
+    path_lower TEXT PRIMARY KEY,
+    path_display TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_folder INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending (folder TEXT PRIMARY KEY, seen INTEGER NOT NULL);
+"""
+
+
+Entry = namedtuple("Entry", ["path_lower", "path_display", "name", "is_folder"])
+FolderFiles = namedtuple("FolderFiles", ["images", "texts"])
+
+
+def parent_of(path_lower):
+    return path_lower.rsplit("/", 1)[0] or "/"
+
+
+def index_entries(entries):
+    # Bucket the files by parent folder in one pass, so every folder lookup
+    # afterwards is a dictionary hit instead of a scan of the whole listing
+    index = {}
+    for entry in entries:
+        if entry.is_folder:
+            continue
+        files = index.setdefault(parent_of(entry.path_lower), FolderFiles([], []))
+        if entry.path_lower.endswith(".png"):
+            files.images.append(entry)
+        elif entry.path_lower.endswith(".txt"):
+            files.texts.append(entry)
+    return index
+
+
+def files_in(index, folder):
+    return index.get(folder.path_lower) or FolderFiles([], [])
+
+
+class ListingState:
+    # Mirror of one Dropbox folder tree, the cursor to continue listing from and
+    # the folders that changed since they were last processed. Changes are kept
+    # in memory and save() writes only the rows they touched.
+    def __init__(self, root):
+        self.root = root.lower().rstrip("/")
+        slug = re.sub(r"[^a-z0-9_-]+", "_", self.root).strip("_")
+        digest = hashlib.sha1(self.root.encode("utf-8")).hexdigest()[:8]
+        self.path = os.path.join(LISTING_DIR, f"{slug}-{digest}.sqlite3")
+        self.reset()
+        self.cleared = False
+        self.load()
+
+    def reset(self):
+        self.cursor = None
+        self.entries = {}
+        # Folder -> order its latest change was seen in, oldest first
+        self.pending = {}
+        self.seen = 0
+        self.cleared = True
+        self.changed_entries = set()
+        self.changed_pending = set()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        with connect(self.path, SCHEMA) as connection:
+            row = connection.execute(
+                "SELECT value FROM state WHERE key = 'cursor'"
+            ).fetchone()
+            self.cursor = row[0] if row else None
+            self.entries = {
+                row[0]: Entry(row[0], row[1], row[2], bool(row[3]))
+                for row in connection.execute("SELECT * FROM entries")
+            }
+            self.pending = dict(
+                connection.execute("SELECT folder, seen FROM pending ORDER BY seen")
+            )
+        self.seen = max(self.pending.values(), default=0)
+
+    def save(self):
+        with connect(self.path, SCHEMA) as connection:
+            if self.cleared:
+                for table in ("state", "entries", "pending"):
+                    connection.execute(f"DELETE FROM {table}")
+            connection.execute(
+                "INSERT OR REPLACE INTO state VALUES ('cursor', ?)", (self.cursor,)
+            )
+            for path in self.changed_entries:
+                entry = self.entries.get(path)
+                if entry is None:
+                    connection.execute(
+                        "DELETE FROM entries WHERE path_lower = ?", (path,)
+                    )
+                else:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                        (*entry[:3], int(entry.is_folder)),
+                    )
+            for folder in self.changed_pending:
+                if folder in self.pending:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO pending VALUES (?, ?)",
+                        (folder, self.pending[folder]),
+                    )
+                else:
+                    connection.execute(
+                        "DELETE FROM pending WHERE folder = ?", (folder,)
+                    )
+        self.cleared = False
+        self.changed_entries = set()
+        self.changed_pending = set()
+
+    def _touch(self, folder):
+        # Folders are kept in the order their changes were seen
+        self.pending.pop(folder, None)
+        self.seen += 1
+        self.pending[folder] = self.seen
+        self.changed_pending.add(folder)
+
+    def _forget(self, path):
+        # Drop an entry, and everything under it when it is a folder
+        removed = self.entries.pop(path, None)
+        paths = [path]
+        if removed is None or removed.is_folder:
+            prefix = path + "/"
+            paths += [entry for entry in self.entries if entry.startswith(prefix)]
+            for entry in paths[1:]:
+                del self.entries[entry]
+            paths += [folder for folder in self.pending if folder.startswith(prefix)]
+        self.changed_entries.update(paths)
+        for folder in paths:
+            if self.pending.pop(folder, None) is not None:
+                self.changed_pending.add(folder)
+
+    def apply(self, changes):
+        # changes are (entry, deleted) pairs as listed by Dropbox
+        for entry, deleted in changes:
+            if deleted:
+                self._forget(entry.path_lower)
+                self._touch(parent_of(entry.path_lower))
+            else:
+                self.entries[entry.path_lower] = entry
+                self.changed_entries.add(entry.path_lower)
+                if entry.is_folder:
+                    self._touch(entry.path_lower)
+                else:
+                    self._touch(parent_of(entry.path_lower))
+
+    def pending_folders(self):
+        # Folders with unprocessed changes, newest changes first
+        return [
+            self.entries[folder]
+            for folder in reversed(self.pending)
+            if folder in self.entries and folder != self.root
+        ]
+
+    def mark_synced(self, folder):
+        # Kept in memory until the next save(), once per sync run
+        if self.pending.pop(folder, None) is not None:
+            self.changed_pending.add(folder)
@@ -0,0 +1,97 @@
+import openai
+import streamlit as st
+import environment as env
+import _retry as retry
+import _limiter as limit
+import _llm_cache as llm_cache
+
+
+# Openai Keys
+env.load_env_variables()
+openai.api_key = env.get_api_key("OPENAI_API_KEY")
+
+
+def warn_retry(attempt, error, delay):
+    st.warning(
+        f"Attempt {attempt} failed. Error message: {error}\nTrying again in {delay:.1f}s..."
+    )
+
+
+def chat_completion(
+    messages, model="gpt-3.5-turbo", cache=False, bypass_cache=False, **kwargs
+):
+    # Every chat model call goes through the shared limiter and retry policy.
+    # Deterministic prompt templates pass cache=True to reuse earlier answers,
+    # bypass_cache=True skips the lookup but still stores the fresh answer.
+    if cache:
+        key = llm_cache.make_key(model, messages, **kwargs)
+        if not bypass_cache:
+            cached = llm_cache.get(key)
+            if cached is not None:
+                return cached
+
+    limiter = limit.get_limiter(model)
+    estimated = limit.estimate_tokens(messages, model, kwargs.get("max_tokens"))
+
+    def request():
+        # Queue before each attempt instead of finding out about limits from a 429
+        wait = limiter.acquire(estimated)
+        if wait > 1:
+            st.info(f"Waited {wait:.1f}s for the {model} rate limit...")
+        try:
+            return openai.ChatCompletion.create(
+                messages=messages, model=model, **kwargs
+            )
+        except Exception:
+            # Only the attempt that succeeds is settled, failed ones give back
+            # their reservation so retries don't stay charged to the bucket
+            limiter.release(estimated)
+            raise
+
+    try:
+        response = retry.call(request, on_retry=warn_retry)
+    except Exception as e:
+        st.error(f"{model} request failed. Error message: {e}")
+        raise
+
+    limiter.settle(estimated, response.get("usage", {}).get("total_tokens"))
+    if cache:
+        llm_cache.put(key, model, response)
+    return response
+
+
+def stream_chat_completion(messages, model="gpt-3.5-turbo", **kwargs):
+    # Yields the completion text as it arrives. Retries only cover opening the
+    # stream, a connection lost halfway through surfaces to the caller.
+    limiter = limit.get_limiter(model)
+    estimated = limit.estimate_tokens(messages, model, kwargs.get("max_tokens"))
+
+    def request():
+        wait = limiter.acquire(estimated)
+        if wait > 1:
+            st.info(f"Waited {wait:.1f}s for the {model} rate limit...")
+        try:
+            return openai.ChatCompletion.create(
+                messages=messages, model=model, stream=True, **kwargs
+            )
+        except Exception:
+            limiter.release(estimated)
+            raise
+
+    try:
+        chunks = retry.call(request, on_retry=warn_retry)
+    except Exception as e:
+        st.error(f"{model} request failed. Error message: {e}")
+        raise
+
+    # Streamed answers carry no usage, so settle on the length of the text, also
+    # when the consumer stops early or the stream breaks off
+    produced = 0
+    try:
+        for chunk in chunks:
+            content = chunk["choices"][0].get("delta", {}).get("content")
+            if content:
+                produced += len(content)
+                yield content
+    finally:
+        limiter.settle(estimated, limit.estimate_tokens(messages, model, produced // 4))
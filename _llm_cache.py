@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import hashlib
+from _local_cache import CACHE_DIR, Counters, connect
+
+
+# Where the cache lives and how much of it we keep
+CACHE_PATH = os.path.join(CACHE_DIR, "llm_cache.sqlite3")
+TTL_SECONDS = 7 * 24 * 60 * 60
+MAX_BYTES = 50 * 1024 * 1024
+
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        model TEXT,
+        value TEXT,
+        size INTEGER,
+        created REAL,
+        accessed REAL
+    )
+"""
+
+
+counters = Counters("hits", "misses", "writes", "evictions")
+
+
+def _connect():
+    return connect(CACHE_PATH, SCHEMA)
+
+
+def make_key(model, messages, **params):
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get(key, ttl=TTL_SECONDS):
+    now = time.time()
+    with _connect() as connection:
+        row = connection.execute(
+            "SELECT value, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or now - row[1] > ttl:
+            counters.count("misses")
+            return None
+        connection.execute(
+            "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+        )
+
+    counters.count("hits")
+    return json.loads(row[0])
+
+
+def put(key, model, response, max_bytes=MAX_BYTES, ttl=TTL_SECONDS):
+    value = json.dumps(response)
+    now = time.time()
+    with _connect() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, value, len(value), now, now),
+        )
+        counters.count("writes")
+        _evict(connection, now, max_bytes, ttl)
+
+
+def _evict(connection, now, max_bytes, ttl):
+    # Expired entries go first, then the least recently used until we fit
+    evicted = connection.execute(
+        "DELETE FROM responses WHERE created < ?", (now - ttl,)
+    ).rowcount
+
+    total = connection.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM responses"
+    ).fetchone()[0]
+    if total > max_bytes:
+        rows = connection.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        ).fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+        evicted += len(stale)
+
+    if evicted:
+        counters.count("evictions", evicted)
+
+
+def stats():
+    return counters.snapshot()
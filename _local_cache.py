@@ -0,0 +1,36 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# Every local cache lives under this directory
+CACHE_DIR = os.getenv("THIRDBRAIN_CACHE_DIR", ".cache")
+
+
+@contextmanager
+def connect(path, schema):
+    # Short lived SQLite connection with its tables in place, commits on success
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    connection = sqlite3.connect(path, timeout=10)
+    connection.executescript(schema)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+class Counters:
+    # Thread-safe hit/miss style counters of a cache
+    def __init__(self, *names):
+        self.values = dict.fromkeys(names, 0)
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.values[name] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
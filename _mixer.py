@@ -1,11 +1,23 @@
 import environment as env
 import openai
 import json
+import time
 import datetime
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
+from spotipy.cache_handler import CacheFileHandler, MemoryCacheHandler
 import streamlit as st
 import os
+import re
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import _llm as llm
+import _retry as retry
+import _track_cache as track_cache
+from _local_cache import CACHE_DIR
 
 
 client_id = env.get_api_key("SPOTIFY_ID")
@@ -24,6 +36,86 @@ if client_id == None or client_secret == None:
 openai.api_key = env.get_api_key("OPENAI_API_KEY")
 
 
+# Spotify searches in flight at the same time
+SEARCH_WORKERS = 8
+
+# Spotify accepts at most this many tracks per add request
+ADD_TRACKS_CHUNK = 100
+
+# Completion tokens one song takes in the generated JSON array, with headroom,
+# and the most a gpt-3.5-turbo completion can use next to the prompt
+TOKENS_PER_SONG = 25
+MAX_COMPLETION_TOKENS = {"gpt-3.5-turbo": 3000, "gpt-3.5-turbo-16k": 15000}
+
+
+# How long resolved seeds and their recommendations are reused, and how many
+# of each are kept
+RECOMMENDATION_TTL = 10 * 60
+RECOMMENDATION_MEMO_SIZE = 256
+
+# OAuth tokens are kept here per scope, spotipy's default ".cache" file would
+# collide with the cache directory
+TOKEN_DIR = os.path.join(CACHE_DIR, "spotify")
+
+
+Resolution = namedtuple("Resolution", ["track", "query", "error"])
+
+
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+_seeds = {}  # normalized search text -> seed track id
+_recommendations = {}  # seed track id -> recommended tracks
+_memo_lock = threading.Lock()
+
+
+def get_session():
+    # One keep-alive pool shared by every Spotify client and token request,
+    # big enough for the search workers
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=SEARCH_WORKERS)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def get_client(scope=None, redirect_uri=redirect_uri, open_browser=True):
+    # One authenticated client per scope, built on first use and reused by every
+    # call after. No scope means app credentials, enough for search and
+    # recommendations.
+    key = (scope, redirect_uri)
+    with _clients_lock:
+        if key not in _clients:
+            session = get_session()
+            if scope is None:
+                auth_manager = SpotifyClientCredentials(
+                    client_id=client_id,
+                    client_secret=client_secret,
+                    requests_session=session,
+                    cache_handler=MemoryCacheHandler(),
+                )
+            else:
+                os.makedirs(TOKEN_DIR, exist_ok=True)
+                slug = re.sub(r"[^a-z0-9]+", "_", scope.lower())
+                auth_manager = SpotifyOAuth(
+                    client_id=client_id,
+                    client_secret=client_secret,
+                    redirect_uri=redirect_uri,
+                    scope=scope,
+                    open_browser=open_browser,
+                    requests_session=session,
+                    cache_handler=CacheFileHandler(
+                        cache_path=os.path.join(TOKEN_DIR, f"{slug}.json")
+                    ),
+                )
+            _clients[key] = spotipy.Spotify(
+                auth_manager=auth_manager, requests_session=session
+            )
+    return _clients[key]
+
+
 def generate_playlist(prompt, count):
     example_json = """
       [
@@ -66,8 +158,20 @@ def generate_playlist(prompt, count):
         },
     ]
 
-    response = openai.ChatCompletion.create(
-        messages=messages, model="gpt-3.5-turbo", max_tokens=400
+    # Long playlists need a bigger completion, and past what fits next to the
+    # prompt, the 16k model
+    try:
+        songs = int(count)
+    except ValueError:
+        songs = 5
+    max_tokens = max(400, TOKENS_PER_SONG * songs + 100)
+    model = "gpt-3.5-turbo"
+    if max_tokens > MAX_COMPLETION_TOKENS[model]:
+        model = "gpt-3.5-turbo-16k"
+    max_tokens = min(max_tokens, MAX_COMPLETION_TOKENS[model])
+
+    response = llm.chat_completion(
+        messages=messages, model=model, max_tokens=max_tokens
     )
 
     output = response["choices"][0]["message"]["content"]
@@ -76,49 +180,101 @@ def generate_playlist(prompt, count):
     return playlist
 
 
-def spotify_playlist(playlist: json, playlist_name: str, popularity: int):
-    sp = spotipy.Spotify(
-        auth_manager=spotipy.SpotifyOAuth(
-            client_id=client_id,
-            client_secret=client_secret,
-            redirect_uri=redirect_uri,
-            scope="playlist-modify-private",
-            open_browser=True,
+def search_track(sp, query):
+    # Top result of a query, None when Spotify has nothing for it.
+    # Spotify 429s are retried after the Retry-After they carry.
+    # https://developer.spotify.com/documentation/web-api/reference/#/operations/search
+    search_results = retry.call(sp.search, q=query, limit=10, type="track")
+    items = search_results["tracks"]["items"]
+    if not items:
+        return None
+    return {
+        "id": items[0]["id"],
+        "name": items[0]["name"],
+        "popularity": items[0]["popularity"],
+    }
+
+
+def cached_search(sp, artist, song, kind, query):
+    # Songs resolved before, hits and misses alike, skip the API call
+    found, track = track_cache.get(artist, song, kind)
+    if not found:
+        track = search_track(sp, query)
+        track_cache.put(artist, song, kind, track)
+    return track
+
+
+def resolve_track(sp, item, popularity):
+    artist, song = item["artist"], item["song"]
+    queries = [
+        ("advanced", f"artist:({artist}) track:({song})"),
+        ("basic", f"{song} {artist}"),
+    ]
+
+    try:
+        # The basic query only goes out when the advanced one missed
+        for kind, query in queries:
+            track = cached_search(sp, artist, song, kind, query)
+            if track is not None and track["popularity"] >= popularity:
+                return Resolution(track, query, None)
+    except Exception as e:
+        return Resolution(None, None, e)
+    return Resolution(None, None, None)
+
+
+def resolve_tracks(sp, playlist, popularity, max_workers=SEARCH_WORKERS):
+    # Resolve every item concurrently, results come back in playlist order.
+    # Workers don't touch Streamlit, the caller reports the results.
+    if not playlist:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(playlist))) as executor:
+        return list(
+            executor.map(lambda item: resolve_track(sp, item, popularity), playlist)
         )
-    )
+
+
+def add_tracks(sp, playlist_id, track_uris, chunk_size=ADD_TRACKS_CHUNK):
+    # Chunks go out one after another so the playlist keeps the generated order,
+    # progress is reported after each one. Returns the number of tracks added.
+    if not track_uris:
+        return 0
+    progress = st.progress(0.0, text="Adding songs to the playlist...")
+    added = 0
+    for start in range(0, len(track_uris), chunk_size):
+        chunk = track_uris[start : start + chunk_size]
+        try:
+            retry.call(sp.playlist_add_items, playlist_id, chunk)
+        except Exception as e:
+            st.error(f"Added {added} of {len(track_uris)} songs, then failed: {e}")
+            break
+        added += len(chunk)
+        progress.progress(
+            added / len(track_uris), text=f"Added {added}/{len(track_uris)} songs"
+        )
+    return added
+
+
+def spotify_playlist(playlist: json, playlist_name: str, popularity: int):
+    sp = get_client("playlist-modify-private")
 
     current_user = sp.current_user()
     assert current_user is not None
 
+    st.info(f"Searching Spotify for {len(playlist)} songs...")
     track_uris = []
-    for item in playlist:
-        artist, song = item["artist"], item["song"]
-        # https://developer.spotify.com/documentation/web-api/reference/#/operations/search
-
-        advanced_query = f"artist:({artist}) track:({song})"
-        basic_query = f"{song} {artist}"
-
-        for query in [advanced_query, basic_query]:
-            st.info(f"Searching from Spotify: {query}")
-            search_results = sp.search(
-                q=query, limit=10, type="track"
-            )  # , market=market)
-
-            if (
-                not search_results["tracks"]["items"]
-                or search_results["tracks"]["items"][0]["popularity"] < popularity
-            ):
-                continue
-            else:
-                good_guess = search_results["tracks"]["items"][0]
-                st.success(f"Found: {good_guess['name']} [{good_guess['id']}]")
-                # print(f"FOUND USING QUERY: {query}")
-                track_uris.append(good_guess["id"])
-                break
-
+    for item, resolution in zip(playlist, resolve_tracks(sp, playlist, popularity)):
+        good_guess = resolution.track
+        if good_guess is not None:
+            st.success(f"Found: {good_guess['name']} [{good_guess['id']}]")
+            track_uris.append(good_guess["id"])
+        elif resolution.error is not None:
+            st.warning(
+                f"Searching {item['song']} by {item['artist']} failed: "
+                f"{resolution.error}. Skipping."
+            )
         else:
             st.info(
-                f"Queries {advanced_query} and {basic_query} returned no good results. Skipping."
+                f"Queries for {item['song']} by {item['artist']} returned no good results. Skipping."
             )
 
     created_playlist = sp.user_playlist_create(
@@ -127,21 +283,14 @@ def spotify_playlist(playlist: json, playlist_name: str, popularity: int):
         name=f"{playlist_name} ({datetime.datetime.now().strftime('%c')})",
     )
 
-    sp.user_playlist_add_tracks(current_user["id"], created_playlist["id"], track_uris)
+    add_tracks(sp, created_playlist["id"], track_uris)
 
     st.success(f"Created playlist: {created_playlist['name']}")
     st.success(created_playlist["external_urls"]["spotify"])
 
 
 def get_user_playlists():
-    sp = spotipy.Spotify(
-        auth_manager=spotipy.SpotifyOAuth(
-            client_id=client_id,
-            client_secret=client_secret,
-            redirect_uri="http://localhost:9999",
-            scope="playlist-read-private",
-        )
-    )
+    sp = get_client("playlist-read-private", redirect_uri="http://localhost:9999")
 
     playlists = sp.current_user_playlists(limit=50)
     all_playlists = []
@@ -157,16 +306,52 @@ def get_user_playlists():
     return all_playlists
 
 
+def _memoized(memo, key, loader, ttl=RECOMMENDATION_TTL):
+    now = time.monotonic()
+    with _memo_lock:
+        cached = memo.get(key)
+    if cached is not None and now - cached[0] < ttl:
+        return cached[1]
+
+    value = loader()
+    with _memo_lock:
+        # Expired entries go first, then the oldest one when the memo is full
+        for stale in [k for k, (fetched, _) in memo.items() if now - fetched >= ttl]:
+            del memo[stale]
+        if len(memo) >= RECOMMENDATION_MEMO_SIZE:
+            del memo[min(memo, key=lambda k: memo[k][0])]
+        memo[key] = (now, value)
+    return value
+
+
 def get_recommendations(track_name):
-    client_credentials_manager = SpotifyClientCredentials(
-        client_id=client_id, client_secret=client_secret
-    )
-    sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+    # Recommendations are memoized per seed track, and the seed per search text,
+    # so browsing costs one round trip per distinct seed
+    sp = get_client()
+
+    def find_seed():
+        results = retry.call(sp.search, q=track_name, type="track", limit=1)
+        items = results["tracks"]["items"]
+        return items[0]["id"] if items else None
 
-    # Get track URI
-    results = sp.search(q=track_name, type="track")
-    track_uri = results["tracks"]["items"][0]["uri"]
+    seed = _memoized(_seeds, track_cache.normalize(track_name), find_seed)
+    if seed is None:
+        return []
 
     # Get recommended tracks
-    recommendations = sp.recommendations(seed_tracks=[track_uri])["tracks"]
-    return recommendations
+    return _memoized(
+        _recommendations,
+        seed,
+        lambda: retry.call(sp.recommendations, seed_tracks=[seed])["tracks"],
+    )
+
+
+def pick_image(images, min_width):
+    # Smallest image at least min_width wide, the largest one if none is
+    if not images:
+        return None
+    images = sorted(images, key=lambda image: image.get("width") or 0)
+    for image in images:
+        if (image.get("width") or 0) >= min_width:
+            return image["url"]
+    return images[-1]["url"]
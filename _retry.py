@@ -0,0 +1,156 @@
+import time
+import random
+import asyncio
+import logging
+import email.utils
+import openai
+import dropbox
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+
+# Backoff parameters, delays are in seconds
+MAX_ATTEMPTS = 4
+BASE_DELAY = 1
+MAX_DELAY = 30
+
+# Longest Retry-After we are willing to honour before giving up instead
+MAX_RETRY_AFTER = 60
+
+# HTTP statuses that are worth another attempt, other 4xx are the caller's fault
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    dropbox.exceptions.RateLimitError,
+    dropbox.exceptions.InternalServerError,
+    requests.ConnectionError,
+    requests.Timeout,
+)
+
+FATAL_ERRORS = (
+    openai.error.InvalidRequestError,
+    openai.error.AuthenticationError,
+    openai.error.PermissionError,
+    openai.error.InvalidAPIType,
+)
+
+
+def status_of(error):
+    for attribute in ("http_status", "status_code"):
+        status = getattr(error, attribute, None)
+        if status is not None:
+            return status
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def headers_of(error):
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    return headers or {}
+
+
+def retry_after(error):
+    # Seconds the provider asked us to wait, either as a number or an HTTP date
+    backoff = getattr(error, "backoff", None)
+    if backoff is not None:
+        # Dropbox hands the Retry-After value over already parsed
+        return max(float(backoff), 0)
+    headers = headers_of(error)
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        moment = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(moment.timestamp() - time.time(), 0)
+
+
+def is_retryable(error):
+    if isinstance(error, FATAL_ERRORS):
+        return False
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    status = status_of(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return False
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts=MAX_ATTEMPTS,
+        base_delay=BASE_DELAY,
+        max_delay=MAX_DELAY,
+        max_retry_after=MAX_RETRY_AFTER,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt, error):
+        # Full jitter exponential backoff, unless the provider told us how long to wait
+        requested = retry_after(error)
+        if requested is not None:
+            return requested + random.uniform(0, self.base_delay)
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def should_retry(self, attempt, error):
+        if attempt >= self.max_attempts or not is_retryable(error):
+            return False
+        requested = retry_after(error)
+        return requested is None or requested <= self.max_retry_after
+
+    def _next_delay(self, attempt, error, on_retry):
+        if not self.should_retry(attempt, error):
+            raise error
+        delay = self.delay(attempt, error)
+        logger.warning(
+            "Attempt %s failed with %r, retrying in %.1fs", attempt, error, delay
+        )
+        if on_retry is not None:
+            on_retry(attempt, error, delay)
+        return delay
+
+    def call(self, fn, *args, on_retry=None, **kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(attempt, e, on_retry)
+            time.sleep(delay)
+
+    async def acall(self, fn, *args, on_retry=None, **kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._next_delay(attempt, e, on_retry)
+            await asyncio.sleep(delay)
+
+
+default_policy = RetryPolicy()
+
+
+def call(fn, *args, on_retry=None, **kwargs):
+    return default_policy.call(fn, *args, on_retry=on_retry, **kwargs)
+
+
+async def acall(fn, *args, on_retry=None, **kwargs):
+    return await default_policy.acall(fn, *args, on_retry=on_retry, **kwargs)
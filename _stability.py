@@ -0,0 +1,92 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import environment as env
+
+
+# Stable.ai Keys
+env.load_env_variables()
+api_host = os.getenv("API_HOST", "https://api.stability.ai")
+api_key = env.get_api_key("STABILITY_API_KEY")
+if api_key is None:
+    raise Exception("Missing Stability API key.")
+
+
+# Keep-alive connections kept open to the Stability host
+POOL_SIZE = 8
+
+# Timeouts in seconds, generations with many steps can take a while to answer
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 120
+
+
+class StabilityError(Exception):
+    def __init__(self, response):
+        super().__init__("Non-200 response: " + str(response.text))
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+
+_session = None
+_adapter = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    # One pooled session per process, the auth headers are built only once
+    global _session, _adapter
+    with _session_lock:
+        if _session is None:
+            _adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session = requests.Session()
+            session.mount(api_host, _adapter)
+            session.headers.update(
+                {
+                    "Content-Type": "application/json",
+                    "Accept": "application/json",
+                    "Authorization": f"Bearer {api_key}",
+                }
+            )
+            _session = session
+    return _session
+
+
+def connection_stats():
+    # urllib3 counts requests and opened connections per pool, the gap is reuse
+    stats = {"requests": 0, "new_connections": 0, "reused_connections": 0}
+    if _adapter is None:
+        return stats
+
+    pools = _adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        try:
+            pool = pools[key]
+        except KeyError:
+            # The pool was evicted while we were reading
+            continue
+        stats["requests"] += pool.num_requests
+        stats["new_connections"] += pool.num_connections
+
+    stats["reused_connections"] = max(stats["requests"] - stats["new_connections"], 0)
+    return stats
+
+
+def text_to_image(prompt, width, height, engine_id, samples, steps):
+    response = get_session().post(
+        f"{api_host}/v1/generation/{engine_id}/text-to-image",
+        json={
+            "text_prompts": [{"text": f"{prompt}"}],
+            "cfg_scale": 7,
+            "clip_guidance_preset": "FAST_BLUE",
+            "height": height,
+            "width": width,
+            "samples": samples,
+            "steps": steps,
+        },
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+    )
+
+    if response.status_code != 200:
+        raise StabilityError(response)
+    return response.json()
@@ -1,13 +1,15 @@
 import os
 import openai
 from typing import List
-import time
-import requests
-import base64
 import dropbox
 import streamlit as st
 from environment import load_env_variables, get_api_key
-from database import fetch_all_book_titles
+import _imagery as img
+import _llm as llm
+from _artist import create_images
+from _uploads import upload_and_share, image_urls, thumbnail_urls
+from _thumbnails import with_thumbnails
+from database import fetch_all_book_titles, insert_book
 
 
 # Openai Keys
@@ -15,15 +17,6 @@ load_env_variables()
 openai.api_key = get_api_key("OPENAI_API_KEY")
 
 
-# Stable.ai Keys
-api_host = os.getenv("API_HOST", "https://api.stability.ai")
-url = f"{api_host}/v1/user/account"
-engine_id = "stable-diffusion-v1-5"
-api_key = get_api_key("STABILITY_API_KEY")
-if api_key is None:
-    raise Exception("Missing Stability API key.")
-
-
 # Dropbox Keys
 APP_KEY = get_api_key("APP_KEY")
 APP_SECRET = get_api_key("APP_SECRET")
@@ -35,11 +28,6 @@ dbx = dropbox.Dropbox(
 )
 
 
-# Looping parameters for error handling
-MAX_ATTEMPTS = 2
-DELAY_SECONDS = 10
-
-
 def read_file_contents():
     try:
         # List all files and folders in the /books folder of Dropbox
@@ -111,55 +99,44 @@ def book_picker(all_books):
     return books
 
 
+def clean_book_title(response):
+    return (
+        response["choices"][0]["message"]["content"]
+        .replace(".", "")
+        .replace("=", "")
+        .replace(":", "")
+        .replace("'", "")
+        .replace(",", "")
+        .replace('"', "")
+    )
+
+
 def get_book(books, all_books):
     st.info("Selecting random book...")
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=books, model="gpt-3.5-turbo", max_tokens=50
-            )
-            book = (
-                response["choices"][0]["message"]["content"]
-                .replace(".", "")
-                .replace("=", "")
-                .replace(":", "")
-                .replace("'", "")
-                .replace(",", "")
-                .replace('"', "")
-            )
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+    response = llm.chat_completion(messages=books, model="gpt-3.5-turbo", max_tokens=50)
+    book = clean_book_title(response)
 
     while book in all_books:
         # Book has already been  selected, choose a different one
         st.warning("Oh, you've read this book already. Choosing a different book...")
 
-        for attempt in range(1, MAX_ATTEMPTS + 1):
-            try:
-                response = openai.ChatCompletion.create(
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": f"""
-                            You are a professional life coach with great knowledge of charisma and leadership. Having witnessed a wide range of experiences, overcome challenges, and achieved success in life, you will choose books that teach users to better their lives.
-                        """,
-                        },
-                        {
-                            "role": "user",
-                            "content": f"""
+        response = llm.chat_completion(
+            messages=[
+                {
+                    "role": "system",
+                    "content": f"""
+            You are a professional life coach with great knowledge of charisma and leadership. Having witnessed a wide range of experiences, overcome challenges, and achieved success in life, you will choose books that teach users to better their lives.
+        """,
+                },
+                {
+                    "role": "user",
+                    "content": f"""
                         I have read this book already, please give me 1 different book. Different than these books: {all_books}
                         """,
-                        },
-                        {
-                            "role": "assistant",
-                            "content": """
+                },
+                {
+                    "role": "assistant",
+                    "content": """
                         Desired format:
                         Book Title by Author Name
 
@@ -167,10 +144,10 @@ def get_book(books, all_books):
                         "Book Title" by Aurhor name
                         Book Title: Author name
                         """,
-                        },
-                        {
-                            "role": "assistant",
-                            "content": """
+                },
+                {
+                    "role": "assistant",
+                    "content": """
                         Just 1 book, no more. Give me just text in form of desired format, nothing else. No = or . or : either. 
 
                         Example template:
@@ -180,59 +157,39 @@ def get_book(books, all_books):
                         Brain Rules 12 Principles for Surviving and Thriving at Work Home and School by John Medina
 
                         """,
-                        },
-                    ],
-                    model="gpt-3.5-turbo",
-                    max_tokens=50,
-                )
-                book = (
-                    response["choices"][0]["message"]["content"]
-                    .replace(".", "")
-                    .replace("=", "")
-                    .replace(":", "")
-                    .replace("'", "")
-                    .replace(",", "")
-                    .replace('"', "")
-                )
-                # If the code execution is successful, break out of the loop
-                if book not in all_books:
-                    break
-            except Exception as e:
-                # Handle RateLimitError
-                st.error(
-                    f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-                )
-            # Wait for the specified delay before the next attempt
-            time.sleep(DELAY_SECONDS)
+                },
+            ],
+            model="gpt-3.5-turbo",
+            max_tokens=50,
+        )
+        book = clean_book_title(response)
 
     st.success(f"{book}")
 
     return book
 
 
-def summarize_book(book: str) -> str:
+def summarize_book(book: str, bypass_cache: bool = False) -> str:
     st.info("Summarizing...")
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+    response = llm.chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": """
                     You are a professional writer and book summarizer. To write effective content, both "perplexity" and "burstiness" are important. Perplexity assesses text complexity and burstiness evaluates sentence variation. People often write with a mix of long and short sentences, while machine-generated sentences tend to be uniform. You need to ensure a suitable balance of both perplexity and burstiness.
 
                     Remember that while summarizing, it's crucial to maintain the integrity of the author's ideas and voice. Use your own words to explain the concepts, but ensure that you capture the essence of the original content accurately.
 
                     Write in-depth and detailed.
                     """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Summarize this book: {book}",
-                    },
-                    {
-                        "role": "assistant",
-                        "content": """
+            },
+            {
+                "role": "user",
+                "content": f"Summarize this book: {book}",
+            },
+            {
+                "role": "assistant",
+                "content": """
                     You are an assistant that speaks only in Markdown code. Do not write text that is not formatted as Markdown code.
                     Desired format:
                     ## Introduction
@@ -250,20 +207,12 @@ def summarize_book(book: str) -> str:
                     ### Tags
                     Add tags based on the mood or emotion of the book.
                     """,
-                    },
-                ],
-                model="gpt-3.5-turbo",
-            )
-
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+            },
+        ],
+        model="gpt-3.5-turbo",
+        cache=True,
+        bypass_cache=bypass_cache,
+    )
 
     summary = response["choices"][0]["message"]["content"]
 
@@ -272,25 +221,23 @@ def summarize_book(book: str) -> str:
     return summary
 
 
-def get_cover_prompt(book):
+def get_cover_prompt(book, bypass_cache=False):
     st.info("Creating prompt for the images...")
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+    response = llm.chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": """
             As a seasoned artist and photographer, you possess extensive expertise and skill honed over the years. Your journey has been filled with invaluable experiences, where you've embraced failures as valuable lessons and triumphed in your pursuit of capturing breathtaking visuals. 
             """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Generate a short, under 400 characters long, written textual representation of an image from this book: {book}",
-                    },
-                    {
-                        "role": "assistant",
-                        "content": """
+            },
+            {
+                "role": "user",
+                "content": f"Generate a short, under 400 characters long, written textual representation of an image from this book: {book}",
+            },
+            {
+                "role": "assistant",
+                "content": """
             Generate a short written textual, max 400 characters long, representation of the image that captures the essence, mood, and theme of the book. Incorporate key terms extracted from the input provided. Consider a suitable color scheme that aligns with the intended atmosphere. Use evocative language to describe visuals that reflect the plot, themes, significant elements or characters of the input. Do your best to captivate the core message visually. The output should not contain any images, only a textual representation of an art piece. Avoid any apologies or examples. 
 
             Here are 10 great examples of textual representation of art pieces that you can learn from:
@@ -317,20 +264,12 @@ def get_cover_prompt(book):
 
             Please bear in mind that the aforementioned illustrations serve only as a reference and a source of inspiration. It is crucial to employ photographic vocabulary in crafting a distinct and customized textual depiction FROM THE USER INPUT. Under 400 charachters long.
             """,
-                    },
-                ],
-                model="gpt-3.5-turbo",
-            )
-
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+            },
+        ],
+        model="gpt-3.5-turbo",
+        cache=True,
+        bypass_cache=bypass_cache,
+    )
 
     image_prompt = response["choices"][0]["message"]["content"]
 
@@ -338,77 +277,6 @@ def get_cover_prompt(book):
     return image_prompt
 
 
-def create_dalle_image(prompt, samples):
-    st.info("Drawing DALL-E image...")
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            image_response = openai.Image.create(
-                prompt=prompt,
-                n=samples,
-                size="512x512",
-                response_format="b64_json",  # Get image data instead of url
-            )
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-            image_response = None
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
-
-    # Return url instead of b64_json
-    # image_url = image_response["data"][0]["url"]
-
-    st.success("DALL-E image created!")
-    return image_response
-
-
-def create_stable_image(prompt, width, height, engine_id, samples, steps):
-    st.info("Drawing Stable image...")
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = requests.post(
-                f"{api_host}/v1/generation/{engine_id}/text-to-image",
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {api_key}",
-                },
-                json={
-                    "text_prompts": [{"text": f"{prompt}"}],
-                    "cfg_scale": 7,
-                    "clip_guidance_preset": "FAST_BLUE",
-                    "height": height,
-                    "width": width,
-                    "samples": samples,
-                    "steps": steps,
-                },
-            )
-
-            if response.status_code != 200:
-                data = "No stability book"
-                st.error("Stable not in a drawing mood today")
-                raise Exception("Non-200 response: " + str(response.text))
-            else:
-                data = response.json()
-
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle the specific exception (if known) or catch all exceptions
-            st.error(f"Attempt {attempt} failed. Waiting a bit and trying again...")
-
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
-
-    st.success("Stable image created!")
-
-    return data
-
-
 def save_all(
     book_title,
     book_content,
@@ -447,22 +315,42 @@ def save_all(
         data_to_txt = f"""
         **Prompt:** {image_prompt}\n\n**Stable Diffusion:** {engine} {width}x{height}\n\n**DALL-E:** 512x512\n\n{book_content}
         """
-        dbx.files_upload(data_to_txt.encode("utf-8"), summary_path)
-
-        # Save DALL-E images to png
-        for i, image in enumerate(dalle_data["data"]):
-            image_path = f"{folder_path}/{new_book}_dalle_{i}.png"
-            image_data = base64.b64decode(image["b64_json"])
-            dbx.files_upload(image_data, image_path)
-            dalle_images.append(image_data)
-
-        # Save Stability images to png
-        if stability_data != "No stability book":
-            for i, image in enumerate(stability_data["artifacts"]):
-                image_path = f"{folder_path}/{new_book}_stability_{i}.png"
-                image_data = base64.b64decode(image["base64"])
-                dbx.files_upload(image_data, image_path)
-                stability_images.append(image_data)
+
+        def files():
+            # Images are decoded one at a time while the previous ones upload
+            yield summary_path, data_to_txt.encode("utf-8")
+
+            # Save DALL-E images to png
+            for i, image_data in enumerate(img.drain_images("dalle", dalle_data)):
+                yield f"{folder_path}/{new_book}_dalle_{i}.png", image_data
+
+            # Save Stability images to png
+            for i, image_data in enumerate(
+                img.drain_images("stability", stability_data)
+            ):
+                yield f"{folder_path}/{new_book}_stability_{i}.png", image_data
+
+        manifest = upload_and_share(dbx, with_thumbnails(files()))
+        for upload in manifest:
+            if not upload.ok:
+                st.error(f"Could not upload {upload.path} to Dropbox: {upload.error}")
+
+        dalle_images = image_urls(manifest, "dalle")
+        stability_images = image_urls(manifest, "stability")
+
+        # The title reads "<book> by <author>"
+        author_name = new_book.rsplit(" by ", 1)[1] if " by " in new_book else ""
+
+        # Save summary and image urls to database
+        st.sidebar.info("Saving to database")
+        insert_book(
+            new_book,
+            author_name.strip(),
+            data_to_txt,
+            image_urls(manifest),
+            thumbnail_urls(manifest),
+        )
+        st.sidebar.success("Database updated!")
 
     except Exception as e:
         # Handle the specific exception (if known) or catch all exceptions
@@ -497,8 +385,7 @@ def summarizer(book_input, width, height, engine, samples, steps):
     book_content = f"{st.session_state.new_book}\n\n{st.session_state.book_summary}"
 
     dalle_prompt = get_cover_prompt(book_content)
-    dalle_image = create_dalle_image(dalle_prompt, samples)
-    stable_image = create_stable_image(
+    dalle_image, stable_image = create_images(
         dalle_prompt, width, height, engine, samples, steps
     )
 
@@ -518,12 +405,12 @@ def summarizer(book_input, width, height, engine, samples, steps):
     )
     with st.session_state.new_expander:
         # Display DALL-E images
-        for image_data in st.session_state.dalle_cover:
-            st.image(image_data)
+        for image_url in st.session_state.dalle_cover:
+            st.image(image_url)
 
         # Display stability images
-        for image_data in st.session_state.stable_cover:
-            st.image(image_data)
+        for image_url in st.session_state.stable_cover:
+            st.image(image_url)
 
         st.title(st.session_state.new_book)
         st.write(st.session_state.book_summary)
@@ -0,0 +1,30 @@
+import io
+import os
+from PIL import Image
+
+
+# Gallery thumbnails, small enough for a two column expander
+THUMBNAIL_SIZE = (384, 384)
+THUMBNAIL_QUALITY = 75
+
+
+def thumbnail_path(path):
+    # Thumbnails sit next to their original, e.g. cover_0.png -> cover_0.thumb.webp
+    return f"{os.path.splitext(path)[0]}.thumb.webp"
+
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail(size)
+        output = io.BytesIO()
+        image.save(output, format="WEBP", quality=quality)
+    return output.getvalue()
+
+
+def with_thumbnails(files):
+    # Yield every (path, bytes) pair followed by the thumbnail of each PNG, so a
+    # lazy upload stream gets its thumbnails without holding images any longer
+    for path, data in files:
+        yield path, data
+        if path.lower().endswith(".png"):
+            yield thumbnail_path(path), make_thumbnail(data)
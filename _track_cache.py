@@ -0,0 +1,77 @@
+import os
+import re
+import time
+from _local_cache import CACHE_DIR, Counters, connect
+
+
+# Where Spotify search results are kept and for how long. Misses expire sooner
+# since the catalogue keeps growing.
+CACHE_PATH = os.path.join(CACHE_DIR, "track_cache.sqlite3")
+TTL_SECONDS = 30 * 24 * 60 * 60
+NEGATIVE_TTL_SECONDS = 24 * 60 * 60
+
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tracks (
+        artist TEXT,
+        song TEXT,
+        kind TEXT,
+        track_id TEXT,
+        name TEXT,
+        popularity INTEGER,
+        fetched REAL,
+        PRIMARY KEY (artist, song, kind)
+    )
+"""
+
+
+counters = Counters("hits", "misses", "writes")
+
+
+def _connect():
+    return connect(CACHE_PATH, SCHEMA)
+
+
+def normalize(text):
+    return re.sub(r"\s+", " ", text.casefold()).strip()
+
+
+def get(artist, song, kind, ttl=TTL_SECONDS, negative_ttl=NEGATIVE_TTL_SECONDS):
+    # Returns (found, track). found is False when Spotify has to be asked,
+    # track is None when Spotify had nothing for this song last time.
+    with _connect() as connection:
+        row = connection.execute(
+            "SELECT track_id, name, popularity, fetched FROM tracks "
+            "WHERE artist = ? AND song = ? AND kind = ?",
+            (normalize(artist), normalize(song), kind),
+        ).fetchone()
+
+    if row is None or time.time() - row[3] > (ttl if row[0] else negative_ttl):
+        counters.count("misses")
+        return False, None
+
+    counters.count("hits")
+    if row[0] is None:
+        return True, None
+    return True, {"id": row[0], "name": row[1], "popularity": row[2]}
+
+
+def put(artist, song, kind, track):
+    with _connect() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                normalize(artist),
+                normalize(song),
+                kind,
+                track["id"] if track else None,
+                track["name"] if track else None,
+                track["popularity"] if track else None,
+                time.time(),
+            ),
+        )
+    counters.count("writes")
+
+
+def stats():
+    return counters.snapshot()
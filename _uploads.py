@@ -0,0 +1,174 @@
+import time
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import dropbox
+import _retry as retry
+from _links import resolve as resolve_shared_links
+from _thumbnails import thumbnail_path
+
+
+# Uploads in flight at the same time
+MAX_WORKERS = 6
+
+# Files up to this size are uploaded as closed sessions and committed together
+# in one finish_batch call, bigger ones go through files_upload on their own
+BATCH_LIMIT = 8 * 1024 * 1024
+
+# Files that get a public shared link, the images and their thumbnails
+SHARED_EXTENSIONS = (".png", ".thumb.webp")
+
+# Most sessions Dropbox commits in one finish_batch request
+BATCH_ENTRIES = 1000
+
+
+@dataclass
+class Upload:
+    path: str
+    size: int
+    ok: bool = False
+    error: Exception = None
+    attempts: int = 0
+    latency: float = 0.0
+    url: str = None
+
+
+def _upload_one(dbx, upload, data):
+    def count_retry(attempt, error, delay):
+        upload.attempts = attempt
+
+    started_at = time.perf_counter()
+    try:
+        retry.call(dbx.files_upload, data, upload.path, on_retry=count_retry)
+        upload.ok = True
+    except Exception as e:
+        upload.error = e
+    upload.attempts += 1
+    upload.latency = time.perf_counter() - started_at
+
+
+def _start_session(dbx, upload, data):
+    # Send the bytes as a closed session, only the tiny cursor is kept afterwards
+    def count_retry(attempt, error, delay):
+        upload.attempts = attempt
+
+    started_at = time.perf_counter()
+    try:
+        result = retry.call(
+            dbx.files_upload_session_start, data, close=True, on_retry=count_retry
+        )
+    except Exception as e:
+        upload.error = e
+        return None
+    finally:
+        upload.attempts += 1
+        upload.latency = time.perf_counter() - started_at
+    return dropbox.files.UploadSessionFinishArg(
+        cursor=dropbox.files.UploadSessionCursor(result.session_id, upload.size),
+        commit=dropbox.files.CommitInfo(path=upload.path),
+    )
+
+
+def _finish_one(dbx, upload, entry):
+    # The bytes are already on Dropbox, committing the session again is enough
+    try:
+        retry.call(dbx.files_upload_session_finish, b"", entry.cursor, entry.commit)
+        upload.ok = True
+        upload.error = None
+    except Exception as e:
+        upload.error = e
+
+
+def _finish_batch(dbx, entries):
+    # finish_batch_v2 commits synchronously, so once it returns no job is left
+    # running that could race with a later commit of the same session
+    result = retry.call(dbx.files_upload_session_finish_batch_v2, entries)
+    return result.entries
+
+
+def upload_files(dbx, files, max_workers=MAX_WORKERS):
+    # Upload (path, bytes) pairs concurrently and return a manifest entry per
+    # file, in input order. files can be a lazy iterable: it is only advanced
+    # when an upload slot is free, so at most max_workers payloads are held at
+    # once. Small files are committed in one batch, and any file the batch
+    # could not commit gets committed on its own.
+    manifest, sessions, in_flight = [], [], set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for path, data in files:
+            if len(in_flight) >= max_workers:
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            upload = Upload(path, len(data))
+            manifest.append(upload)
+            if upload.size <= BATCH_LIMIT:
+                future = executor.submit(_start_session, dbx, upload, data)
+                sessions.append((upload, future))
+            else:
+                future = executor.submit(_upload_one, dbx, upload, data)
+            in_flight.add(future)
+        wait(in_flight)
+
+        committed = [
+            (upload, future.result())
+            for upload, future in sessions
+            if future.result() is not None
+        ]
+        leftovers = []
+        for start in range(0, len(committed), BATCH_ENTRIES):
+            chunk = committed[start : start + BATCH_ENTRIES]
+            try:
+                results = _finish_batch(dbx, [entry for _, entry in chunk])
+            except Exception:
+                results = [None] * len(chunk)
+            for (upload, entry), result in zip(chunk, results):
+                if result is not None and result.is_success():
+                    upload.ok = True
+                else:
+                    leftovers.append(executor.submit(_finish_one, dbx, upload, entry))
+        wait(leftovers)
+
+    return manifest
+
+
+def upload_and_share(dbx, files, max_workers=MAX_WORKERS):
+    # Same as upload_files, with the shared URL of every uploaded image and
+    # thumbnail filled in so callers can store it without listing the folder
+    # again. Text files stay private.
+    manifest = upload_files(dbx, files, max_workers=max_workers)
+    urls, errors = resolve_shared_links(
+        dbx,
+        [
+            upload.path
+            for upload in manifest
+            if upload.ok and upload.path.lower().endswith(SHARED_EXTENSIONS)
+        ],
+    )
+    for upload in manifest:
+        if upload.path in urls:
+            upload.url = urls[upload.path]
+        elif upload.path in errors:
+            upload.ok = False
+            upload.error = errors[upload.path]
+    return manifest
+
+
+def image_urls(manifest, provider=None):
+    # URLs of the uploaded images, optionally only the ones a provider made
+    return [
+        upload.url
+        for upload in manifest
+        if upload.url
+        and upload.path.lower().endswith(".png")
+        and (provider is None or f"_{provider}_" in upload.path)
+    ]
+
+
+def thumbnail_urls(manifest, provider=None):
+    # Thumbnail URL of every image image_urls returns, in the same order. An
+    # image whose thumbnail did not make it falls back to the original.
+    urls = {upload.path: upload.url for upload in manifest if upload.url}
+    return [
+        urls.get(thumbnail_path(upload.path), upload.url)
+        for upload in manifest
+        if upload.url
+        and upload.path.lower().endswith(".png")
+        and (provider is None or f"_{provider}_" in upload.path)
+    ]
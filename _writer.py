@@ -1,11 +1,16 @@
+import re
+import itertools
 import openai
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from environment import load_env_variables, get_api_key
-import time
+import _llm as llm
 from database import (
     insert_ebook_title,
     insert_ebook_table_of_content,
     insert_ebook_chapter,
     insert_target_audience,
+    insert_batch_written,
 )
 import streamlit as st
 
@@ -15,25 +20,29 @@ load_env_variables()
 openai.api_key = get_api_key("OPENAI_API_KEY")
 
 
-# Looping parameters for error handling
-MAX_ATTEMPTS = 2
-DELAY_SECONDS = 10
+# Chapters drafted at the same time by write_chapters
+BATCH_WORKERS = 4
+
+# "## Chapter 3: ...", "**Prologue**" and friends open a chapter in a manuscript
+CHAPTER_HEADING = re.compile(
+    r"^\s*(?:#{1,6}\s*|\*\*)?(chapter\s+\d+|prologue|epilogue)\b", re.IGNORECASE
+)
+# "3. Chapter title" at the top level opens a chapter in a table of contents
+NUMBERED_ITEM = re.compile(r"^\d+\.\s+\S")
 
 
 def new_ebook(user_input, target_audience):
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+    response = llm.chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": """
             You are an esteemed best-selling book author known for your unique and engaging content that provides immense value to readers.
             """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"""
+            },
+            {
+                "role": "user",
+                "content": f"""
                         Please, brainstorm book titles based on user input:
                         {user_input}
                         
@@ -42,26 +51,17 @@ def new_ebook(user_input, target_audience):
 
                         Using the user input and target audience provided, I kindly request your expertise in creating something that is completely distinct from any existing book title in the market. Utilize keyword research tools to identify popular search terms related to topic. Please provide me with ONE compelling title. Thank you.
                         """,
-                    },
-                    {
-                        "role": "assistant",
-                        "content": f"""
+            },
+            {
+                "role": "assistant",
+                "content": f"""
             Desired format:
             Title of Your Unique Book
                     """,
-                    },
-                ],
-                model="gpt-3.5-turbo",
-            )
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+            },
+        ],
+        model="gpt-3.5-turbo",
+    )
 
     ebook_title = (
         response["choices"][0]["message"]["content"]
@@ -78,19 +78,17 @@ def new_ebook(user_input, target_audience):
 
 
 def new_fiction_ebook(user_input, target_audience):
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+    response = llm.chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": """
             You are an esteemed best-selling book author known for your unique and engaging content that provides immense value to readers.
             """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"""
+            },
+            {
+                "role": "user",
+                "content": f"""
                         Please, brainstorm FICTION book titles based on user input:
                         {user_input}
                         
@@ -99,26 +97,17 @@ def new_fiction_ebook(user_input, target_audience):
 
                         Using the user input and target audience provided, I kindly request your expertise in creating something that is completely distinct from any existing book title in the market. Utilize keyword research tools to identify popular search terms related to topic. Please provide me with ONE compelling FICTION book title. Thank you.
                         """,
-                    },
-                    {
-                        "role": "assistant",
-                        "content": f"""
+            },
+            {
+                "role": "assistant",
+                "content": f"""
             Desired format:
             Title of Your Unique Book
                     """,
-                    },
-                ],
-                model="gpt-3.5-turbo",
-            )
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+            },
+        ],
+        model="gpt-3.5-turbo",
+    )
 
     ebook_title = (
         response["choices"][0]["message"]["content"]
@@ -135,19 +124,17 @@ def new_fiction_ebook(user_input, target_audience):
 
 
 def table_of_content(ebook, user_input, target_audience):
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+    response = llm.chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": """
                     You are an accomplished best-selling Book author renowned for your ability to create engaging and valuable content. Remember that maintaining a suitable balance between perplexity and burstiness is crucial in crafting effective text. Perplexity assesses the complexity of the writing, while burstiness evaluates the variation in sentence structures. By incorporating a mix of long and short sentences, you can ensure a captivating reading experience for your audience.
                     """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"""
+            },
+            {
+                "role": "user",
+                "content": f"""
                         Based on this user input:
                         {user_input} 
 
@@ -159,10 +146,10 @@ def table_of_content(ebook, user_input, target_audience):
 
                         Using the user input, target audience and book title provided, I kindly request your expertise in creating a captivating table of contents for this book. Consider how the content will best resonate with target audience and address their specific needs and interests. This process allows you to refine this book's angle, structure, and tone, ensuring that it captures the attention of target audience and provides them with the value they are seeking. Utilize keyword research tools to identify popular search terms related to this book. Thank you.
                         """,
-                    },
-                    {
-                        "role": "assistant",
-                        "content": f"""
+            },
+            {
+                "role": "assistant",
+                "content": f"""
                     Provide long, ind-depth and detailed table of contests and script for the book formatted in Markdown code. Avoid any apologies or compliments. Consider the overall arc of non-fiction eBook. Begin with main themes or key ideas that will form the basis for each chapter or section of the book. Within each chapter, ALWAYS include NUMBERED subtopics that expand on the main theme which allow to dig deeper into each subject, providing valuable insights and practical advice. 
                     
                     # {ebook} 
@@ -192,20 +179,10 @@ def table_of_content(ebook, user_input, target_audience):
                     17. Q&A Section
                     18. Additional Resources/Appendix (optional)
                     """,
-                    },
-                ],
-                model="gpt-3.5-turbo-16k",
-            )
-
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+            },
+        ],
+        model="gpt-3.5-turbo-16k",
+    )
 
     content = response["choices"][0]["message"]["content"]
 
@@ -216,20 +193,17 @@ def table_of_content(ebook, user_input, target_audience):
     return content
 
 
-def manuscript(table_of_content, target_audience):
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+def manuscript_messages(table_of_content, target_audience):
+    return [
+        {
+            "role": "system",
+            "content": """
                     You are an accomplished best-selling Book author renowned for your ability to create engaging and valuable content. Remember that maintaining a suitable balance between perplexity and burstiness is crucial in crafting effective text. Perplexity assesses the complexity of the writing, while burstiness evaluates the variation in sentence structures. By incorporating a mix of long and short sentences, you can ensure a captivating reading experience for your audience.
                     """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"""
+        },
+        {
+            "role": "user",
+            "content": f"""
                         For this books table of content:
                         {table_of_content}
 
@@ -239,10 +213,10 @@ def manuscript(table_of_content, target_audience):
                         I kindly request your expertise in creating a captivating manuscript for this book. Consider how the content will best resonate with target audience and address their specific needs and interests. This process allows you to refine this book's angle, structure, and tone, ensuring that it captures the attention of target audience and provides them with the value they are seeking.
 
                         """,
-                    },
-                    {
-                        "role": "assistant",
-                        "content": f"""
+        },
+        {
+            "role": "assistant",
+            "content": f"""
                         Provide long in-depth and detailed manuscript for the book formatted in Markdown code. Consider the overall arc of non-fiction book. Begin with main themes or key ideas that will form the basis for each chapter or section of the book. Within each chapter, include subtopics that expand on the main theme which allow to dig deeper into each subject, providing valuable insights and practical advice.
 
                         Who ever will read this manuscript should have clear instructions what to write and how to write it. Remember to maintain logical progression, allowing ideas to build upon one another and creating a sense of continuity. Consider incorporating storytelling elements or personal anecdotes that relate to each chapter's theme. This will help in establishing an emotional connection with readers. Futhermore, for example, if one chapter has mentioned a character, in the next chapter it should be mentioned so there is a continuum. Aim to add all necessary details with EACH section inside of a chapter, so that if previous chapter is forgotten, the writer can continue the story with all it characters, and details by following the manuscript.
@@ -260,40 +234,41 @@ def manuscript(table_of_content, target_audience):
                         - Additional Resources/Appendix (optional)
                             -Include any relevant resources, links, or references that can further enhance the reader's understanding or provide additional value.
                     """,
-                    },
-                ],
-                model="gpt-3.5-turbo-16k",
-            )
+        },
+    ]
 
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+
+def manuscript(table_of_content, target_audience):
+    response = llm.chat_completion(
+        messages=manuscript_messages(table_of_content, target_audience),
+        model="gpt-3.5-turbo-16k",
+    )
 
     content = response["choices"][0]["message"]["content"]
 
     return content
 
 
+def stream_manuscript(table_of_content, target_audience):
+    # Yields the manuscript as it is written, the caller decides where to keep it
+    yield from llm.stream_chat_completion(
+        messages=manuscript_messages(table_of_content, target_audience),
+        model="gpt-3.5-turbo-16k",
+    )
+
+
 def fiction_manuscript(ebook, target_audience):
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+    response = llm.chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": """
                     You are an accomplished best-selling Book author renowned for your ability to create engaging and valuable content. Remember that maintaining a suitable balance between perplexity and burstiness is crucial in crafting effective text. Perplexity assesses the complexity of the writing, while burstiness evaluates the variation in sentence structures. By incorporating a mix of long and short sentences, you can ensure a captivating reading experience for your audience.
                     """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"""
+            },
+            {
+                "role": "user",
+                "content": f"""
                         For this fiction book:
                         {ebook}
 
@@ -303,10 +278,10 @@ def fiction_manuscript(ebook, target_audience):
                         I kindly request your expertise in creating a captivating FICTION manuscript for book I am going to write. Consider how the content will best resonate with target audience and address their specific needs and interests. This process allows you to refine this book's angle, structure, and tone, ensuring that it captures the attention of target audience and provides them with the value they are seeking.
 
                         """,
-                    },
-                    {
-                        "role": "assistant",
-                        "content": f"""
+            },
+            {
+                "role": "assistant",
+                "content": f"""
                         Provide LONG, in-depth and detailed FICTION manuscript for the book formatted in Markdown code. Consider the overall arc of FICTION book. Split each chapter in to a smaller peaces, so it is easier to write small chunk at a time.
 
                         Who ever will read this manuscript should have clear instructions what to write and how to write it. Remember to maintain logical progression, allowing ideas to build upon one another and creating a sense of continuity. Futhermore, for example, if one chapter has mentioned a character, in the next chapter it should be mentioned so there is a continuum. Aim to add all necessary details with EACH section inside of a chapter, so that if previous chapter is forgotten, the writer can continue the story with all it characters, and details by following the manuscript.
@@ -332,20 +307,10 @@ def fiction_manuscript(ebook, target_audience):
                         ## Epilogue
                         *A concluding section that offers closure or a glimpse into the characters' future after the main events of the story have concluded. Similar to the prologue, the length of the epilogue can vary.*
                     """,
-                    },
-                ],
-                model="gpt-3.5-turbo-16k",
-            )
-
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+            },
+        ],
+        model="gpt-3.5-turbo-16k",
+    )
 
     content = response["choices"][0]["message"]["content"]
 
@@ -356,45 +321,37 @@ def fiction_manuscript(ebook, target_audience):
     return content
 
 
-def write_chapter(ebook, chapter_nro, chapter_to_write, target_audience):
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+def chapter_messages(ebook, chapter_to_write, target_audience):
+    return [
+        {
+            "role": "system",
+            "content": """
                     You are a highly acclaimed best-selling author, renowned for your exceptional storytelling abilities and captivating prose. You have been focusing on self help books, learned your from mistakes and eventually succeeded. Remember that maintaining a suitable balance between perplexity and burstiness is crucial in crafting effective text. Perplexity assesses the complexity of the writing, while burstiness evaluates the variation in sentence structures. By incorporating a mix of long and short sentences, you can ensure a captivating reading experience for your audience.
                     """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"""
+        },
+        {
+            "role": "user",
+            "content": f"""
                     I would greatly appreciate if you could write the following section of my book {ebook}:
                     {chapter_to_write} 
                     """,
-                    },
-                    {
-                        "role": "assistant",
-                        "content": f"""                      
+        },
+        {
+            "role": "assistant",
+            "content": f"""                      
 
                     Write long in-depth with markdown. Remember you are writing section of the book, so write LONG paragraphs, NO bullet points or numbered lists. You can use bold and italic formatting when it fits to the theme. Choose language that is clear, concise, and accessible to your target audience:
                     {target_audience}
                     """,
-                    },
-                ],
-                model="gpt-3.5-turbo",
-            )
+        },
+    ]
 
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+
+def write_chapter(ebook, chapter_nro, chapter_to_write, target_audience):
+    response = llm.chat_completion(
+        messages=chapter_messages(ebook, chapter_to_write, target_audience),
+        model="gpt-3.5-turbo",
+    )
 
     chapter_response = response["choices"][0]["message"]["content"]
 
@@ -404,25 +361,101 @@ def write_chapter(ebook, chapter_nro, chapter_to_write, target_audience):
     return chapter_response
 
 
-def get_ebook_prompt(user_input):
+def stream_chapter(ebook, chapter_nro, chapter_to_write, target_audience):
+    # Yields the chapter as it is written and saves it once the model is done
+    chunks = []
+    for chunk in llm.stream_chat_completion(
+        messages=chapter_messages(ebook, chapter_to_write, target_audience),
+        model="gpt-3.5-turbo",
+    ):
+        chunks.append(chunk)
+        yield chunk
+
+    # Save chapter to database
+    insert_ebook_chapter(ebook, chapter_nro, "".join(chunks))
+
+
+def split_table_of_content(table_of_content):
+    # Fiction manuscripts come with chapter headings, non-fiction outlines with a
+    # numbered list where sections and subsections are indented under a chapter
+    lines = table_of_content.splitlines()
+    for opens_chapter, nested_only in ((CHAPTER_HEADING, False), (NUMBERED_ITEM, True)):
+        sections = []
+        for line in lines:
+            if opens_chapter.match(line):
+                sections.append([line])
+            elif sections and (
+                not nested_only
+                or line.startswith((" ", "\t", "-"))
+                or not line.strip()
+            ):
+                sections[-1].append(line)
+        if sections:
+            return ["\n".join(section).strip() for section in sections]
+    return []
+
+
+def write_chapters(
+    ebook,
+    sections,
+    target_audience,
+    written=(),
+    used_chapters=(),
+    max_workers=BATCH_WORKERS,
+):
+    # Drafts every section not in written, the batch_written indexes saved on the
+    # ebook, on a bounded pool. Each goes into the next chapter number not in
+    # used_chapters, so existing and deleted chapters are never overwritten.
+    # Yields (section_nro, chapter_nro, error) as each one finishes. A section
+    # is marked written right after its chapter is saved, so a failed run
+    # resumes from where it stopped when called again.
+    free_chapters = (nro for nro in itertools.count(1) if nro not in used_chapters)
+    pending = [
+        (section_nro, next(free_chapters), section)
+        for section_nro, section in enumerate(sections, start=1)
+        if section_nro not in written
+    ]
+
+    def write(section_nro, chapter_nro, section):
+        write_chapter(ebook, chapter_nro, section, target_audience)
+        insert_batch_written(ebook, section_nro)
+
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=max_workers, initializer=add_script_run_ctx, initargs=(None, ctx)
+    ) as executor:
+        futures = {
+            executor.submit(write, section_nro, chapter_nro, section): (
+                section_nro,
+                chapter_nro,
+            )
+            for section_nro, chapter_nro, section in pending
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+                yield (*futures[future], None)
+            except Exception as e:
+                yield (*futures[future], e)
+
+
+def get_ebook_prompt(user_input, bypass_cache=False):
     st.info("Creating prompt for the images...")
-    for attempt in range(1, MAX_ATTEMPTS + 1):
-        try:
-            response = openai.ChatCompletion.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """
+    response = llm.chat_completion(
+        messages=[
+            {
+                "role": "system",
+                "content": """
             As a seasoned artist and photographer, you possess extensive expertise and skill honed over the years. Your journey has been filled with invaluable experiences, where you've embraced failures as valuable lessons and triumphed in your pursuit of capturing breathtaking visuals. 
             """,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Generate a short, under 400 characters long, written textual representation of an image from this user input: {user_input}",
-                    },
-                    {
-                        "role": "assistant",
-                        "content": """
+            },
+            {
+                "role": "user",
+                "content": f"Generate a short, under 400 characters long, written textual representation of an image from this user input: {user_input}",
+            },
+            {
+                "role": "assistant",
+                "content": """
             Generate a short written textual, max 400 characters long, representation of the image that captures the essence, mood, and theme of the user input. Incorporate key terms extracted from the input provided. Consider a suitable color scheme that aligns with the intended atmosphere. Use evocative language to describe visuals that reflect the plot, themes, significant elements or characters of the input. Do your best to captivate the core message visually. The output should not contain any images, only a textual representation of an art piece. Avoid any apologies or examples. 
 
             Here are 10 great examples of textual representation of art pieces that you can learn from:
@@ -449,20 +482,12 @@ def get_ebook_prompt(user_input):
 
             Please bear in mind that the aforementioned illustrations serve only as a reference and a source of inspiration. It is crucial to employ photographic vocabulary in crafting a distinct and customized textual depiction FROM THE USER INPUT. Under 400 charachters long.
             """,
-                    },
-                ],
-                model="gpt-3.5-turbo",
-            )
-
-            # If the code execution is successful, break out of the loop
-            break
-        except Exception as e:
-            # Handle RateLimitError
-            st.error(
-                f"Attempt{attempt} failed. Rate limit exceeded. Error message: {e}\nWaiting a bit and trying again..."
-            )
-        # Wait for the specified delay before the next attempt
-        time.sleep(DELAY_SECONDS)
+            },
+        ],
+        model="gpt-3.5-turbo",
+        cache=True,
+        bypass_cache=bypass_cache,
+    )
 
     image_prompt = response["choices"][0]["message"]["content"]
 
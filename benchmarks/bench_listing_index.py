@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _listing import Entry, index_entries, files_in
+
+
+# Synthetic /books listing: one summary and a few images per folder
+FOLDERS = 10000
+IMAGES_PER_FOLDER = 4
+
+# The old scan is quadratic, so it is timed on a sample of folders and scaled up
+SCAN_SAMPLE = 200
+
+
+def synthetic_listing():
+    entries = [Entry("/books", "/books", "books", True)]
+    for i in range(FOLDERS):
+        folder = f"/books/Book_{i}_by_Author"
+        entries.append(Entry(folder.lower(), folder, folder[7:], True))
+        entries.append(
+            Entry(f"{folder}/{i}.txt".lower(), f"{folder}/{i}.txt", f"{i}.txt", False)
+        )
+        for j in range(IMAGES_PER_FOLDER):
+            name = f"{i}_dalle_{j}.png"
+            path = f"{folder}/{name}"
+            entries.append(Entry(path.lower(), path, name, False))
+    return entries
+
+
+def scan(entries, folder):
+    # The per-folder rescan the sync functions used to do
+    folder_files = [
+        entry
+        for entry in entries
+        if not entry.is_folder
+        and os.path.dirname(entry.path_display) == folder.path_display
+    ]
+    images = [file for file in folder_files if file.path_display.endswith(".png")]
+    texts = [file for file in folder_files if file.path_display.endswith(".txt")]
+    return images, texts
+
+
+def main():
+    entries = synthetic_listing()
+    folders = [entry for entry in entries if entry.is_folder][1:]
+
+    started = time.perf_counter()
+    for folder in folders[:SCAN_SAMPLE]:
+        scan(entries, folder)
+    scan_seconds = (time.perf_counter() - started) * len(folders) / SCAN_SAMPLE
+
+    started = time.perf_counter()
+    index = index_entries(entries)
+    for folder in folders:
+        files_in(index, folder)
+    index_seconds = time.perf_counter() - started
+
+    # Both ways have to agree on what is in each folder
+    for folder in folders[:SCAN_SAMPLE]:
+        assert scan(entries, folder) == tuple(files_in(index, folder))
+
+    print(f"{len(folders)} folders, {len(entries)} entries")
+    print(f"rescan per folder: {scan_seconds:.2f}s (scaled from {SCAN_SAMPLE})")
+    print(f"index once:        {index_seconds:.4f}s")
+    print(f"speedup:           {scan_seconds / index_seconds:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,19 @@ import os
 import streamlit as st
 import dropbox
 import math
+import threading
 from environment import load_env_variables, get_api_key
-from database import insert_book, insert_art, insert_ebook_art
+from database import (
+    insert_book,
+    insert_art,
+    insert_ebook_art,
+    get_chapter_art,
+    get_chapter_thumbs,
+    get_book,
+    get_art,
+)
+from _listing import Entry, ListingState, index_entries, files_in
+from _links import resolve as resolve_shared_links
 
 
 load_env_variables()
@@ -17,8 +28,59 @@ dbx = dropbox.Dropbox(
     oauth2_refresh_token=DROPBOX_REFRESH_TOKEN,
 )
 
+_sync_lock = threading.Lock()
+
+
+def to_entry(metadata):
+    return Entry(
+        metadata.path_lower,
+        metadata.path_display,
+        metadata.name,
+        isinstance(metadata, dropbox.files.FolderMetadata),
+    )
+
+
+def sync_folder(root):
+    # Page through what changed since the saved cursor, so a sync costs what
+    # changed instead of the size of the whole library
+    with _sync_lock:
+        listing = ListingState(root)
+        result = None
+        if listing.cursor:
+            try:
+                result = dbx.files_list_folder_continue(listing.cursor)
+            except dropbox.exceptions.ApiError as e:
+                if not e.error.is_reset():
+                    raise e
+                # Dropbox expired the cursor, start over with a full listing
+                listing.reset()
+        if result is None:
+            result = dbx.files_list_folder(root, recursive=True)
+
+        while True:
+            listing.apply(
+                (
+                    to_entry(metadata),
+                    isinstance(metadata, dropbox.files.DeletedMetadata),
+                )
+                for metadata in result.entries
+            )
+            if not result.has_more:
+                break
+            result = dbx.files_list_folder_continue(result.cursor)
+
+        listing.cursor = result.cursor
+        listing.save()
+    return listing
+
+
+def keep_thumbnails(record, image_urls):
+    # Images the app saved keep their thumbnails, the others are shown as is
+    record = record or {}
+    known = dict(zip(record.get("img_url") or [], record.get("thumb_url") or []))
+    return [known.get(url, url) for url in image_urls]
+
 
-@st.cache_data()
 def display_book_summaries_and_save_to_database(num_summaries=None):
     if "title" not in st.session_state:
         st.session_state.title = ""
@@ -28,21 +90,16 @@ def display_book_summaries_and_save_to_database(num_summaries=None):
         st.session_state.url = {}
 
     try:
-        # List all files and folders in the /books folder of Dropbox
-        result = dbx.files_list_folder("/books", recursive=True)
-        entries = result.entries
+        # Sync the /books folder of Dropbox, only changed folders are processed
+        listing = sync_folder("/books")
+        index = index_entries(listing.entries.values())
     except dropbox.exceptions.AuthError as e:
         # Handle authentication error
         st.error(f"Dropbox authentication failed: {e}")
         return
 
-    # Filter out folders from the entries
-    folders = [
-        entry for entry in entries if isinstance(entry, dropbox.files.FolderMetadata)
-    ]
-
-    # Reverse the order of the books displayed
-    folders.reverse()
+    # Folders with new or changed files, the latest changes first
+    folders = listing.pending_folders()
 
     for folder in folders:
         folder_name = os.path.basename(folder.path_display).replace("_", " ")
@@ -52,21 +109,8 @@ def display_book_summaries_and_save_to_database(num_summaries=None):
             if folder_name != "books":
                 st.session_state.title = str(folder_name)
 
-        # Get the files inside the folder
-        folder_files = [
-            entry
-            for entry in entries
-            if isinstance(entry, dropbox.files.FileMetadata)
-            and os.path.dirname(entry.path_display) == folder.path_display
-        ]
-
-        # Separate image files and text file
-        image_files = [
-            file for file in folder_files if file.path_display.endswith(".png")
-        ]
-        text_file = [
-            file for file in folder_files if file.path_display.endswith(".txt")
-        ]
+        # Get the image files and text file inside the folder
+        image_files, text_file = files_in(index, folder)
 
         # Calculate the number of columns needed for the images
         num_images = len(image_files)
@@ -80,37 +124,19 @@ def display_book_summaries_and_save_to_database(num_summaries=None):
 
             col1, col2 = st.columns(2)  # Create two columns
 
+            # Resolve every shared link of the folder in one go
+            shared_urls, link_errors = resolve_shared_links(
+                dbx, [file.path_display for file in image_files]
+            )
+
             for i, image_file in enumerate(image_files):
-                try:
-                    shared_link_metadata = dbx.sharing_create_shared_link_with_settings(
-                        image_file.path_display,
-                        dropbox.sharing.SharedLinkSettings(
-                            requested_visibility=dropbox.sharing.RequestedVisibility.public
-                        ),
+                res = shared_urls.get(image_file.path_display)
+                if res is None:
+                    st.sidebar.error(
+                        f"Sharing failed for file {image_file.path_display}: "
+                        f"{link_errors.get(image_file.path_display)}. Skipping..."
                     )
-                except dropbox.exceptions.ApiError as e:
-                    if e.error.is_shared_link_already_exists():
-                        # A shared link already exists, retrieve the existing links for the file
-                        links = dbx.sharing_list_shared_links(
-                            image_file.path_display
-                        ).links
-                        shared_link_metadata = links[
-                            0
-                        ]  # Assuming there is only one existing link, you can modify this logic based on your requirements
-                    elif isinstance(e.error, dropbox.exceptions.InternalServerError):
-                        # Handle InternalServerError and continue to the next iteration
-                        st.sidebar.error(
-                            f"InternalServerError occurred for file {image_file.path_display}. Skipping..."
-                        )
-                        continue
-
-                # Extract the URL from the shared link metadata
-                shared_link_url = shared_link_metadata.url
-
-                # Modify the shared link URL to force file download
-                res = shared_link_url.replace(
-                    "www.dropbox.com", "dl.dropboxusercontent.com"
-                ).split("?")[0]
+                    continue
 
                 # Add the permanent link to the list
                 image_urls.append(res)
@@ -150,10 +176,9 @@ def display_book_summaries_and_save_to_database(num_summaries=None):
                 st.title(st.session_state.title)
                 st.markdown(st.session_state.file_content)
 
-                # Split the string by the delimiter "by"
-                split_string = st.session_state.title.split("by")
-                # Extract the author name (assuming it is the second part after splitting)
-                author_name = split_string[1].strip()
+                # The title reads "<book> by <author>"
+                title = st.session_state.title
+                author_name = title.rsplit(" by ", 1)[1] if " by " in title else ""
 
                 st.sidebar.info("Saving to database")
                 insert_book(
@@ -161,17 +186,20 @@ def display_book_summaries_and_save_to_database(num_summaries=None):
                     author_name,
                     st.session_state.file_content,
                     image_urls,
+                    keep_thumbnails(get_book(st.session_state.title), image_urls),
                 )
                 st.sidebar.success("Database updated!")
-                st.cache_data.clear()
-                st.experimental_rerun()
+
+        listing.mark_synced(folder.path_lower)
 
         # Break the loop if the specified number of summaries is reached
         if num_summaries is not None and len(st.session_state.audio) >= num_summaries:
             break
 
+    # The processed folders are written once, after the whole run
+    listing.save()
+
 
-@st.cache_data()
 def display_art_and_save_to_database(num_art=None):
     if "art_url" not in st.session_state:
         st.session_state.art_url = {}
@@ -181,23 +209,16 @@ def display_art_and_save_to_database(num_art=None):
         st.session_state.art_prompt = {}
 
     try:
-        # List all files and folders in the /books folder of Dropbox
-        all_art = dbx.files_list_folder("/images", recursive=True)
-        art_entries = all_art.entries
+        # Sync the /images folder of Dropbox, only changed folders are processed
+        art_listing = sync_folder("/images")
+        art_index = index_entries(art_listing.entries.values())
     except dropbox.exceptions.AuthError as e:
         # Handle authentication error
         st.error(f"Dropbox authentication failed: {e}")
         return
 
-    # Filter out folders from the entries
-    art_folders = [
-        art_entry
-        for art_entry in art_entries
-        if isinstance(art_entry, dropbox.files.FolderMetadata)
-    ]
-
-    # Reverse the order of the books displayed
-    art_folders.reverse()
+    # Folders with new or changed files, the latest changes first
+    art_folders = art_listing.pending_folders()
 
     for art_folder in art_folders:
         art_folder_name = os.path.basename(art_folder.path_display).replace("_", " ")
@@ -209,21 +230,8 @@ def display_art_and_save_to_database(num_art=None):
 
         expander = st.expander(st.session_state.art_title, expanded=False)
 
-        # Get the files inside the folder
-        art_folder_files = [
-            art_entry
-            for art_entry in art_entries
-            if isinstance(art_entry, dropbox.files.FileMetadata)
-            and os.path.dirname(art_entry.path_display) == art_folder.path_display
-        ]
-
-        # Separate image files and text file
-        art_image_files = [
-            file for file in art_folder_files if file.path_display.endswith(".png")
-        ]
-        art_text_file = [
-            file for file in art_folder_files if file.path_display.endswith(".txt")
-        ]
+        # Get the image files and text file inside the folder
+        art_image_files, art_text_file = files_in(art_index, art_folder)
 
         # Calculate the number of columns needed for the images
         num_images = len(art_image_files)
@@ -236,35 +244,15 @@ def display_art_and_save_to_database(num_art=None):
 
             col1, col2 = st.columns(2)  # Create two columns
 
+            # Resolve every shared link of the folder in one go
+            shared_urls, link_errors = resolve_shared_links(
+                dbx, [file.path_display for file in art_image_files]
+            )
+
             for i, art_image_file in enumerate(art_image_files):
-                # Get shared link for the image file
-                try:
-                    shared_link_metadata = dbx.sharing_create_shared_link_with_settings(
-                        art_image_file.path_display,
-                        dropbox.sharing.SharedLinkSettings(
-                            requested_visibility=dropbox.sharing.RequestedVisibility.public
-                        ),
-                    )
-                except dropbox.exceptions.ApiError as e:
-                    if e.error.is_shared_link_already_exists():
-                        # A shared link already exists, retrieve the existing links for the file
-                        links = dbx.sharing_list_shared_links(
-                            art_image_file.path_display
-                        ).links
-                        shared_link_metadata = links[
-                            0
-                        ]  # Assuming there is only one existing link, you can modify this logic based on your requirements
-                    else:
-                        # Handle other types of ApiError if needed
-                        raise e
-
-                # Extract the URL from the shared link metadata
-                shared_link_url = shared_link_metadata.url
-
-                # Modify the shared link URL to force file download
-                art_res = shared_link_url.replace(
-                    "www.dropbox.com", "dl.dropboxusercontent.com"
-                ).split("?")[0]
+                art_res = shared_urls.get(art_image_file.path_display)
+                if art_res is None:
+                    raise link_errors[art_image_file.path_display]
 
                 # Add the permanent link to the list
                 art_image_urls.append(art_res)
@@ -305,38 +293,39 @@ def display_art_and_save_to_database(num_art=None):
                 st.markdown(st.session_state.art_file_content)
 
                 st.sidebar.info("Saving to database")
+                art_record = get_art(st.session_state.art_title)
                 insert_art(
                     st.session_state.art_title,
                     st.session_state.art_file_content,
                     art_image_urls,
+                    keep_thumbnails(art_record, art_image_urls),
                 )
 
                 st.sidebar.success("Database updated!")
-                st.cache_data.clear()
-                st.experimental_rerun()
+
+        art_listing.mark_synced(art_folder.path_lower)
 
         # Break the loop if the specified number of summaries is reached
         if num_art is not None and len(st.session_state.art_prompt) >= num_art:
             break
 
+    # The processed folders are written once, after the whole run
+    art_listing.save()
+
 
-@st.cache_data()
 def display_files_and_save_to_database(ebook_title, chapter):
     try:
-        # List all files and folders in the /books folder of Dropbox
-        all_art = dbx.files_list_folder(f"/ebooks/{ebook_title}", recursive=True)
-        art_entries = all_art.entries
+        # Sync the ebook folder of Dropbox, the local mirror has every chapter
+        art_listing = sync_folder(f"/ebooks/{ebook_title}")
+        art_entries = list(art_listing.entries.values())
+        art_index = index_entries(art_entries)
     except dropbox.exceptions.AuthError as e:
         # Handle authentication error
         st.error(f"Dropbox authentication failed: {e}")
         return
 
     # Filter out folders from the entries
-    art_folders = [
-        art_entry
-        for art_entry in art_entries
-        if isinstance(art_entry, dropbox.files.FolderMetadata)
-    ]
+    art_folders = [art_entry for art_entry in art_entries if art_entry.is_folder]
 
     # Reverse the order of the books displayed
     art_folders.reverse()
@@ -348,53 +337,39 @@ def display_files_and_save_to_database(ebook_title, chapter):
 
         art_title = str(art_folder_name)
         if art_title == chapter:
-            # Get the files inside the folder
-            art_folder_files = [
-                art_entry
-                for art_entry in art_entries
-                if isinstance(art_entry, dropbox.files.FileMetadata)
-                and os.path.dirname(art_entry.path_display) == art_folder.path_display
-            ]
-
-            # Separate image files and text file
-            art_image_files = [
-                file for file in art_folder_files if file.path_display.endswith(".png")
-            ]
+            # Get the image files inside the folder
+            art_image_files = files_in(art_index, art_folder).images
 
             art_image_urls = []
 
+            # Resolve every shared link of the chapter in one go
+            shared_urls, link_errors = resolve_shared_links(
+                dbx, [file.path_display for file in art_image_files]
+            )
+
             for i, art_image_file in enumerate(art_image_files):
-                # Get shared link for the image file
-                try:
-                    shared_link_metadata = dbx.sharing_create_shared_link_with_settings(
-                        art_image_file.path_display,
-                        dropbox.sharing.SharedLinkSettings(
-                            requested_visibility=dropbox.sharing.RequestedVisibility.public
-                        ),
-                    )
-                except dropbox.exceptions.ApiError as e:
-                    if e.error.is_shared_link_already_exists():
-                        # A shared link already exists, retrieve the existing links for the file
-                        links = dbx.sharing_list_shared_links(
-                            art_image_file.path_display
-                        ).links
-                        shared_link_metadata = links[
-                            0
-                        ]  # Assuming there is only one existing link, you can modify this logic based on your requirements
-                    else:
-                        # Handle other types of ApiError if needed
-                        raise e
-
-                # Extract the URL from the shared link metadata
-                shared_link_url = shared_link_metadata.url
-
-                # Modify the shared link URL to force file download
-                art_res = shared_link_url.replace(
-                    "www.dropbox.com", "dl.dropboxusercontent.com"
-                ).split("?")[0]
+                art_res = shared_urls.get(art_image_file.path_display)
+                if art_res is None:
+                    raise link_errors[art_image_file.path_display]
 
                 # Add the permanent link to the list
 
                 art_image_urls.append(art_res)
 
-            insert_ebook_art(ebook_title, chapter, art_image_urls)
+            # Images saved by the app keep their thumbnails, the others show as is
+            known_thumbs = dict(
+                zip(
+                    get_chapter_art(ebook_title, chapter) or [],
+                    get_chapter_thumbs(ebook_title, chapter),
+                )
+            )
+            insert_ebook_art(
+                ebook_title,
+                chapter,
+                art_image_urls,
+                [known_thumbs.get(url, url) for url in art_image_urls],
+            )
+            art_listing.mark_synced(art_folder.path_lower)
+
+    # The processed folders are written once, after the whole run
+    art_listing.save()
@@ -2,11 +2,13 @@ from deta import Deta
 import streamlit as st
 from environment import load_env_variables, get_api_key
 import datetime
+import math
 import re
 from streamlit_extras.add_vertical_space import add_vertical_space
-import _artist as ar
 import random
 import string
+import threading
+import time
 
 
 load_env_variables()
@@ -17,34 +19,165 @@ db_users = deta.Base("users_db")
 db_books = deta.Base("booksummaries")
 db_art = deta.Base("art")
 db_ebook = deta.Base("ebook")
+db_titles = deta.Base("title_index")
+
+
+# Seconds a Deta read is served from memory. Writes made through this module
+# drop the entries they touch right away, the TTL only bounds how long writes
+# made elsewhere can go unnoticed.
+CACHE_TTL = 300
+
+# Key of the entry holding a whole collection, and of its (title, date) listing
+ALL = "*"
+LISTING = "*listing"
+
+# Expanders rendered per page of the book and art galleries
+PAGE_SIZE = 10
+
+# Records asked from Deta per fetch request, Deta caps a page at 1000
+FETCH_PAGE_SIZE = 1000
+
+
+class KeyedCache:
+    # Process-wide memo of Deta reads keyed by (collection, key), shared by
+    # every session so one user's write leaves the others' entries warm
+    def __init__(self, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        # Bumped on every invalidation, a read that started before one is not
+        # stored since it may hold the record from before the write
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def _generation(self, collection, key):
+        return (
+            self.generations.get((collection, None), 0),
+            self.generations.get((collection, key), 0),
+        )
+
+    def get(self, collection, key, loader):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.entries.get((collection, key))
+            generation = self._generation(collection, key)
+        if cached is not None and now - cached[0] < self.ttl:
+            return cached[1]
+
+        value = loader()
+        with self.lock:
+            if self._generation(collection, key) == generation:
+                self.entries[(collection, key)] = (now, value)
+        return value
+
+    def invalidate(self, collection, key=None):
+        # Drop one entry, or the whole collection when no key is given
+        with self.lock:
+            self.generations[(collection, key)] = (
+                self.generations.get((collection, key), 0) + 1
+            )
+            if key is not None:
+                self.entries.pop((collection, key), None)
+            else:
+                stale = [entry for entry in self.entries if entry[0] == collection]
+                for entry in stale:
+                    del self.entries[entry]
+
+
+cache = KeyedCache()
+
+
+def iter_records(base, query=None, fields=None, page_size=FETCH_PAGE_SIZE, limit=None):
+    # Yield the records of a Deta Base page by page, following the last key
+    # until the collection is exhausted or limit records were yielded. Deta
+    # has no projection, fields trims each record before it is handed out so
+    # callers only keep what they need.
+    count = 0
+    last = None
+    while True:
+        response = base.fetch(query, limit=page_size, last=last)
+        for record in response.items:
+            if limit is not None and count >= limit:
+                return
+            if fields is not None:
+                record = {f: record[f] for f in ("key", *fields) if f in record}
+            yield record
+            count += 1
+        last = response.last
+        if not last:
+            return
+
+
+### Title Index ###
+# One record per collection with the [title, date] pairs of all its records,
+# so listings cost one small request instead of a fetch of every record
+def build_title_index(collection, base):
+    titles = [
+        [record["key"], record.get("date")]
+        for record in iter_records(base, fields=["date"])
+    ]
+    db_titles.put({"key": collection, "titles": titles})
+    return titles
+
+
+def load_title_index(collection, base):
+    # (title, date) of every record, newest first
+    record = db_titles.get(collection)
+    titles = record["titles"] if record else build_title_index(collection, base)
+
+    # A title saved again is appended again, its latest date wins
+    latest = {title: date for title, date in titles}
+    return sorted(latest.items(), key=lambda x: x[1] or "", reverse=True)
+
+
+def index_title(collection, title, date):
+    try:
+        db_titles.update({"titles": db_titles.util.append([[title, date]])}, collection)
+    except Exception:
+        # No index yet or it could not be updated, the next read rebuilds it
+        db_titles.delete(collection)
+
+
+def unindex_title(collection, title):
+    record = db_titles.get(collection)
+    if record:
+        record["titles"] = [entry for entry in record["titles"] if entry[0] != title]
+        db_titles.put(record)
 
 
 ### User Database ###
 def insert_user(username, name, password):
-    return db_users.put({"key": username, "name": name, "password": password})
+    user = db_users.put({"key": username, "name": name, "password": password})
+    invalidate_user(username)
+    return user
 
 
-@st.cache_data()
 def fetch_all_users():
-    res = db_users.fetch()
-    return res.items
+    return cache.get("users", ALL, lambda: list(iter_records(db_users)))
 
 
-@st.cache_data()
 def get_user(username):
-    return db_users.get(username)
+    return cache.get("users", username, lambda: db_users.get(username))
 
 
 def update_user(username, updates):
-    return db_users.update(updates, username)
+    updated = db_users.update(updates, username)
+    invalidate_user(username)
+    return updated
 
 
 def delete_user(username):
-    return db_users.delete(username)
+    deleted = db_users.delete(username)
+    invalidate_user(username)
+    return deleted
+
+
+def invalidate_user(username):
+    cache.invalidate("users", username)
+    cache.invalidate("users", ALL)
 
 
 ### Books Database ###
-def insert_book(title, author, content, img_urls):
+def insert_book(title, author, content, img_urls, thumb_urls=None):
     current_date = datetime.date.today().strftime("%Y-%m-%d")
     db_books.put(
         {
@@ -52,167 +185,143 @@ def insert_book(title, author, content, img_urls):
             "author": author,
             "content": content,
             "img_url": img_urls,
+            "thumb_url": thumb_urls or img_urls,
             "date": current_date,
         }
     )
+    index_title("books", title, current_date)
+    invalidate_book(title)
 
 
 def delete_summary(title):
-    return db_books.delete(title)
+    deleted = db_books.delete(title)
+    unindex_title("books", title)
+    invalidate_book(title)
+    return deleted
+
+
+def invalidate_book(title):
+    cache.invalidate("books", title)
+    cache.invalidate("books", LISTING)
+
+
+def image_caption(image_url):
+    # Extract the caption from the image_url
+    match = re.search(r"_(\w+)_\d+\.png", image_url)
+    return match.group(1) if match else ""
+
+
+def show_image(image_url, thumb_url, key):
+    # Show the thumbnail, the full size image is only downloaded when asked for
+    st.image(thumb_url, caption=image_caption(image_url))
+    if thumb_url != image_url and st.checkbox("Full size", key=key):
+        st.image(image_url)
+
+
+def show_images(image_urls, thumb_urls=None, key=""):
+    # Records saved before thumbnails existed only have the originals
+    if not thumb_urls or len(thumb_urls) != len(image_urls):
+        thumb_urls = image_urls
+
+    col1, col2 = st.columns(2)  # Create two columns
+    for j, (image_url, thumb_url) in enumerate(zip(image_urls, thumb_urls)):
+        # Determine the column to display the image based on the index
+        column = col1 if j % 2 == 0 else col2
+        with column:
+            show_image(image_url, thumb_url, key=f"{key}_full_{j}")
+
+
+def paginate(items, key, page_size=PAGE_SIZE):
+    # Only one page of a listing is rendered, the page picker sits on top
+    pages = max(math.ceil(len(items) / page_size), 1)
+    page = 1
+    if pages > 1:
+        page = st.selectbox(
+            f"Page (of {pages})", range(1, pages + 1), key=f"{key}_page"
+        )
+    start = (page - 1) * page_size
+    return items[start : start + page_size]
+
+
+def book_listing():
+    return cache.get("books", LISTING, lambda: load_title_index("books", db_books))
+
+
+def get_book(title):
+    return cache.get("books", title, lambda: db_books.get(title))
 
 
 # @st.cache_data()
 def fetch_all_books():
-    all_books = db_books.fetch()
-    response = all_books.items
-
-    # Sort the books by date in descending order
-    sorted_books = sorted(response, key=lambda x: x["date"], reverse=True)
-
-    # Initialize empty lists to store the extracted information
-    titles = []
-    authors = []
-    contents = []
-    img_urls_list = []
-
-    # Loop through the sorted books
-    for book in sorted_books:
-        title = book["key"]
-        author = book["author"]
-        content = book["content"]
-        img_urls = book["img_url"]
-
-        # Append the extracted values to the corresponding lists
-        titles.append(title)
-        authors.append(author)
-        contents.append(content)
-        img_urls_list.append(img_urls)
-
-    # Loop through the extracted values for all books
-    for i in range(len(titles)):
-        title = titles[i]
-        author = authors[i]
-        content = contents[i]
-        image_urls = img_urls_list[i]
-        # Generate a random string of length 5
-        # random_string = "".join(
-        #     random.choices(string.ascii_lowercase + string.digits, k=5)
-        # )
-
-        # Display the images in two columns
-        expander = st.expander(
-            title
-        )  # Use the current book title for the expander title
-
-        # Display the images in the expander
-        with expander:
-            col1, col2 = st.columns(2)  # Create two columns
-            for j, image_url in enumerate(image_urls):
-                # Extract the caption from the image_url
-                match = re.search(r"_(\w+)_\d+\.png", image_url)
-                caption = match.group(1) if match else ""
-
-                # Determine the column to display the image based on the index
-                column = col1 if j % 2 == 0 else col2
-
-                # Display the image with the extracted caption
-                with column:
-                    st.image(image_url, caption=caption)
+    # A page of titles is rendered, a summary and its images are only loaded
+    # once asked for
+    for title, date in paginate(book_listing(), key="books"):
+        with st.expander(title):
+            if not st.checkbox(f"Show summary ({date})", key=f"book_show_{title}"):
+                continue
+            book = get_book(title)
+            if not book:
+                st.warning(f"{title} is no longer in the database")
+                continue
+
+            show_images(book["img_url"], book.get("thumb_url"), key=f"book_{title}")
 
             # Display the title and content inside the expander
             st.title(title)
-            st.markdown(content)
+            st.markdown(book["content"])
             add_vertical_space(1)
 
-            # # Provide a unique key for each button
-            # unique_key = f"delete_button_{title}_{j}_{random_string}"
-            # delete_summary_button = st.button(f"Delete {unique_key} summary")
-            # if delete_summary_button:
-            #     print("test")
-
-        #     # delete_summary(title)
-        #     # st.sidebar.warning(f"{title} summary deleted!")
-        #     # st.cache_data.clear()
-        #     # st.experimental_rerun()
 
-
-@st.cache_data()
 def fetch_all_book_titles():
-    all_books = db_books.fetch()
-    response = all_books.items
-
-    # Extract the 'key' values from the response and store them in a tuple
-    titles = tuple(book["key"] for book in response)
-
-    return titles
+    return tuple(title for title, _ in book_listing())
 
 
 ### Art Database ###
-def insert_art(title, content, img_urls):
+def insert_art(title, content, img_urls, thumb_urls=None):
     current_date = datetime.date.today().strftime("%Y-%m-%d")
     db_art.put(
         {
             "key": title,
             "content": content,
             "img_url": img_urls,
+            "thumb_url": thumb_urls or img_urls,
             "date": current_date,
         }
     )
+    index_title("art", title, current_date)
+    invalidate_art(title)
+
+
+def invalidate_art(title):
+    cache.invalidate("art", title)
+    cache.invalidate("art", LISTING)
+
+
+def art_listing():
+    return cache.get("art", LISTING, lambda: load_title_index("art", db_art))
+
+
+def get_art(title):
+    return cache.get("art", title, lambda: db_art.get(title))
 
 
-@st.cache_data()
 def fetch_all_art():
-    all_art = db_art.fetch()
-    art_response = all_art.items
-
-    # Sort the books by date in descending order
-    sorted_art = sorted(art_response, key=lambda x: x["date"], reverse=True)
-
-    # Initialize empty lists to store the extracted information
-    art_titles = []
-    art_contents = []
-    art_img_urls_list = []
-
-    # Loop through the sorted books
-    for art in sorted_art:
-        art_title = art["key"]
-        art_content = art["content"]
-        art_img_urls = art["img_url"]
-
-        # Append the extracted values to the corresponding lists
-        art_titles.append(art_title)
-        art_contents.append(art_content)
-        art_img_urls_list.append(art_img_urls)
-
-    # Loop through the extracted values for all books
-    for i in range(len(art_titles)):
-        art_title = art_titles[i]
-        art_content = art_contents[i]
-        art_image_urls = art_img_urls_list[i]
-
-        # Display the images in two columns
-        expander = st.expander(
-            art_title
-        )  # Use the current book title for the expander title
-
-        # Display the images in the expander
-        with expander:
-            col1, col2 = st.columns(2)  # Create two columns
-            for j, art_image_url in enumerate(art_image_urls):
-                # Extract the caption from the image_url
-                match = re.search(r"_(\w+)_\d+\.png", art_image_url)
-                caption = match.group(1) if match else ""
-
-                # Determine the column to display the image based on the index
-                column = col1 if j % 2 == 0 else col2
-
-                # Display the image with the extracted caption
-                with column:
-                    st.image(art_image_url, caption=caption)
+    # A page of titles is rendered, an art prompt and its images are only
+    # loaded once asked for
+    for art_title, art_date in paginate(art_listing(), key="art"):
+        with st.expander(art_title):
+            if not st.checkbox(f"Show art ({art_date})", key=f"art_show_{art_title}"):
+                continue
+            art = get_art(art_title)
+            if not art:
+                st.warning(f"{art_title} is no longer in the database")
+                continue
+
+            show_images(art["img_url"], art.get("thumb_url"), key=f"art_{art_title}")
 
             # Display the title and content inside the expander
             st.title(art_title)
-            st.markdown(art_content)
+            st.markdown(art["content"])
 
 
 ### eBook Database ###
@@ -224,106 +333,119 @@ def insert_ebook_title(title):
             "date": current_date,
         }
     )
+    index_title("ebooks", title, current_date)
+    invalidate_ebook(title)
+    cache.invalidate("ebooks", ALL)
 
 
 def insert_ebook_table_of_content(title, table_of_content):
     db_ebook.update({"table_of_content": table_of_content}, title)
+    invalidate_ebook(title)
 
 
 def insert_target_audience(title, target_audience):
     db_ebook.update({"target_audience": target_audience}, title)
+    invalidate_ebook(title)
 
 
 def insert_ebook_chapter(title, chapter_nro, chapter_content):
     db_ebook.update({f"chapter_{chapter_nro}": chapter_content}, title)
+    invalidate_ebook(title)
+
+
+def insert_batch_written(title, section_nro):
+    # Table of Content sections "Write All Chapters" has drafted, appended one by
+    # one so concurrent writers don't overwrite each other
+    db_ebook.update({"batch_written": db_ebook.util.append([section_nro])}, title)
+    invalidate_ebook(title)
 
 
 def insert_cover_prompt(title, prompt, neg_prompt):
     db_ebook.update(
         {f"Prompt_Cover": f"{prompt}\n\nNegative Prompt: {neg_prompt}"}, title
     )
+    invalidate_ebook(title)
 
 
-def insert_ebook_art(title, chapter_name, url):
-    db_ebook.update({chapter_name: url}, title)
+def insert_ebook_art(title, chapter_name, url, thumb_urls=None):
+    db_ebook.update(
+        {chapter_name: url, f"Thumbs_{chapter_name}": thumb_urls or url}, title
+    )
+    invalidate_ebook(title)
 
 
 def insert_image_prompt(title, chapter_nro, prompt, neg_prompt):
     db_ebook.update(
         {f"Prompt_{chapter_nro}": f"{prompt}\n\nNegative Prompt: {neg_prompt}"}, title
     )
+    invalidate_ebook(title)
 
 
 def delete_ebook(title):
-    return db_ebook.delete(title)
+    deleted = db_ebook.delete(title)
+    unindex_title("ebooks", title)
+    invalidate_ebook(title)
+    cache.invalidate("ebooks", ALL)
+    return deleted
 
 
-@st.cache_data()
-def fetch_all_ebook_titles():
-    all_ebooks = db_ebook.fetch()
-    response = all_ebooks.items
+def load_ebook(ebook):
+    # Fetch the whole record once and serve every ebook accessor from it
+    return cache.get("ebooks", ebook, lambda: db_ebook.get(ebook) or {})
 
-    # Extract the 'key' values from the response and store them in a tuple
-    titles = tuple(ebook["key"] for ebook in response)
 
-    return titles
+def invalidate_ebook(ebook):
+    cache.invalidate("ebooks", ebook)
+
+
+def fetch_all_ebook_titles():
+    # Served from the title index, never from the chapters each record carries
+    listing = cache.get("ebooks", ALL, lambda: load_title_index("ebooks", db_ebook))
+    return tuple(sorted(title for title, _ in listing))
 
 
-@st.cache_data()
 def get_table_of_content(ebook):
-    selected_ebook = db_ebook.get(ebook)
-    if "table_of_content" in selected_ebook:
-        response = selected_ebook["table_of_content"]
-        return response
-    else:
-        return None
+    return load_ebook(ebook).get("table_of_content")
 
 
-@st.cache_data()
 def get_target_audience(ebook):
-    selected_ebook = db_ebook.get(ebook)
-    if "target_audience" in selected_ebook:
-        response = selected_ebook["target_audience"]
-        return response
-    else:
-        return "Everybody who is interesting in self-development and personal growth."
+    return load_ebook(ebook).get(
+        "target_audience",
+        "Everybody who is interesting in self-development and personal growth.",
+    )
 
 
-@st.cache_data()
 def get_ebook_cover(ebook):
-    selected_ebook = db_ebook.get(ebook)
-    if "Cover" in selected_ebook:
-        response = selected_ebook["Cover"]
-        return response
-    else:
-        return None
+    return load_ebook(ebook).get("Cover")
 
 
-@st.cache_data()
 def get_cover_prompt(ebook):
-    selected_ebook = db_ebook.get(ebook)
-    if "Prompt_Cover" in selected_ebook:
-        response = selected_ebook["Prompt_Cover"]
-        return response
-    else:
-        return None
+    return load_ebook(ebook).get("Prompt_Cover")
 
 
-@st.cache_data()
 def get_chapter_art(ebook, chapter):
-    selected_ebook = db_ebook.get(ebook)
-    if chapter in selected_ebook:
-        response = selected_ebook[chapter]
-        return response
-    else:
-        return None
+    return load_ebook(ebook).get(chapter)
+
+
+def get_chapter_thumbs(ebook, chapter):
+    # Older chapters have no thumbnails, their originals are shown instead
+    urls = get_chapter_art(ebook, chapter) or []
+    thumbs = load_ebook(ebook).get(f"Thumbs_{chapter}") or []
+    return thumbs if len(thumbs) == len(urls) else urls
+
+
+def get_batch_written(ebook):
+    return load_ebook(ebook).get("batch_written") or []
+
+
+def get_chapter_numbers(ebook):
+    # Every chapter number in use, deleted chapters included
+    return [
+        int("".join(filter(str.isdigit, key)))
+        for key in load_ebook(ebook)
+        if key.startswith("chapter_")
+    ]
 
 
-@st.cache_data()
 def get_chapter_prompt(ebook, chapter):
-    selected_ebook = db_ebook.get(ebook)
-    if f"Prompt_{chapter}" in selected_ebook:
-        response = selected_ebook[f"Prompt_{chapter}"]
-        return response
-    else:
-        return None
+    return load_ebook(ebook).get(f"Prompt_{chapter}")
@@ -5,8 +5,8 @@ from _summarizer import summarizer
 import dropbox
 from dropbox.exceptions import AuthError
 import math
-from cloud import display_book_summaries_and_save_to_database
 from database import fetch_all_books
+from cloud import display_book_summaries_and_save_to_database
 
 
 BOOK_FOLDER = "books"
@@ -76,6 +76,11 @@ if st.session_state.authentication_status:
             3,
         )
 
+        # Summaries added to Dropbox outside the app, only new folders are read
+        if st.sidebar.button("Import Summaries from Dropbox"):
+            with st.spinner("Importing from Dropbox..."):
+                display_book_summaries_and_save_to_database()
+
         with st.form("Book", clear_on_submit=True):
             text_input = st.text_input(
                 "Submit a Book to Summarize or Leave Empty for a Random Book:",
@@ -94,7 +99,6 @@ if st.session_state.authentication_status:
                     book_art_samples,
                     book_art_steps,
                 )
-            display_book_summaries_and_save_to_database(1)
 
     ### Option to use Local File Storage ###
     # def display_book_summaries():
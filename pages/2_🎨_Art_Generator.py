@@ -3,8 +3,8 @@ import streamlit as st
 from streamlit_extras.add_vertical_space import add_vertical_space
 from environment import load_env_variables, get_api_key
 import dropbox
-from cloud import display_art_and_save_to_database
 from database import fetch_all_art
+from cloud import display_art_and_save_to_database
 
 
 TITLE = "Photo Artist"
@@ -90,6 +90,11 @@ if st.session_state.authentication_status:
             3,
         )
 
+        # Art added to Dropbox outside the app, only new folders are read
+        if st.sidebar.button("Import Art from Dropbox"):
+            with st.spinner("Importing from Dropbox..."):
+                display_art_and_save_to_database()
+
         with st.form("Art", clear_on_submit=True):
             st.session_state.user_input = st.text_area(
                 "Submit a Description of an Art to Generate:",
@@ -116,7 +121,6 @@ if st.session_state.authentication_status:
                 samples,
                 steps,
             )
-            display_art_and_save_to_database(1)
             st.experimental_rerun()
 
     # Run the app
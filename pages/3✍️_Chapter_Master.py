@@ -6,7 +6,6 @@ import database as db
 import _writer as wr
 import _artist as ar
 import cloud as cl
-import re
 
 
 EBOOK_FOLDER = "ebooks"
@@ -41,6 +40,17 @@ with st.sidebar:
     st.write("💡 Note: API keys required!!")
 
 
+def render_stream(chunks):
+    # Show the text as it arrives and hand back the whole of it
+    placeholder = st.empty()
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        placeholder.markdown(text + "▌")
+    placeholder.markdown(text)
+    return text
+
+
 if "authentication_status" not in st.session_state:
     st.session_state.authentication_status = ""
 if "steps" not in st.session_state:
@@ -117,7 +127,6 @@ if st.session_state.authentication_status:
                     st.session_state.ebook_title, user_input_text, target_audience
                 )
                 st.success("Table of Contents is ready!")
-                st.cache_data.clear()
                 st.experimental_rerun()
     elif ebook_to_write == "Write a New Fiction Book":
         new_fiction_topic = st.form("New Fiction Book")
@@ -137,7 +146,6 @@ if st.session_state.authentication_status:
                     st.session_state.ebook_title, target_audience
                 )
                 st.success("Fiction Manuscript is ready!")
-                st.cache_data.clear()
                 st.experimental_rerun()
 
     else:
@@ -157,25 +165,26 @@ if st.session_state.authentication_status:
 
                 # Display the URLs in two columns
                 if urls:
-                    deleted_url = urls[:]
+                    thumbs = db.get_chapter_thumbs(ebook_title, "Cover")
                     col1, col2 = st.columns(2)  # Create two columns
-                    for j, cover_url in enumerate(urls):
-                        # Extract the caption from the image URL
-                        match = re.search(r"_(\w+)_\d+\.png", cover_url)
-                        caption = match.group(1) if match else ""
-
+                    for j, (cover_url, thumb_url) in enumerate(zip(urls, thumbs)):
                         # Determine the column to display the image based on the index
                         column = col1 if j % 2 == 0 else col2
 
-                        # Display the image with the extracted caption
+                        # Display the thumbnail, the original on demand
                         with column:
-                            st.image(cover_url, caption=caption)
+                            db.show_image(
+                                cover_url, thumb_url, key=f"{ebook_title}_cover_full_{j}"
+                            )
                             delete_cover_button = st.button(f"Delete Cover Art {j}")
                             if delete_cover_button:
-                                deleted_url.remove(cover_url)
-                                db.insert_ebook_art(ebook_title, "Cover", deleted_url)
+                                db.insert_ebook_art(
+                                    ebook_title,
+                                    "Cover",
+                                    urls[:j] + urls[j + 1 :],
+                                    thumbs[:j] + thumbs[j + 1 :],
+                                )
                                 st.error(f"Cover Art {j} deleted!")
-                                st.cache_data.clear()
                                 st.experimental_rerun()
 
                 # Display cover prompt
@@ -192,37 +201,47 @@ if st.session_state.authentication_status:
                 if cover_art_button:
                     cover_prompt = wr.get_ebook_prompt(current_table_of_content)
                     negative_prompt = ar.get_negative_prompt(cover_prompt)
-                    dalle_image = ar.create_dalle_image(
-                        cover_prompt, st.session_state.samples, dalle_num=False
-                    )
-                    stable_image = ar.create_stable_image(
+                    dalle_image, stable_image = ar.create_images(
                         cover_prompt,
                         st.session_state.width,
                         st.session_state.height,
                         st.session_state.engine,
                         st.session_state.samples,
                         st.session_state.steps,
+                        dalle_num=False,
                     )
-                    # Save cover images to the cloud storage
+                    # Save cover images to the cloud storage and database
                     ar.save_chapter_img(
                         ebook_title, "Cover", dalle_image, stable_image, dalle_num=False
                     )
 
-                    # Save cover prompt and urls to database
+                    # Save cover prompt to database
                     db.insert_cover_prompt(ebook_title, cover_prompt, negative_prompt)
-                    cl.display_files_and_save_to_database(ebook_title, "Cover")
-                    st.cache_data.clear()
+                    st.experimental_rerun()
+
+                # Art added to the ebook folders in Dropbox outside the app
+                reimport_art_button = st.button("Re-import Art from Dropbox")
+                if reimport_art_button:
+                    chapter_names = ["Cover"] + [
+                        key.replace("_", " ").capitalize()
+                        for key, value in db.load_ebook(ebook_title).items()
+                        if key.startswith("chapter_") and value != "deleted"
+                    ]
+                    with st.spinner("Importing from Dropbox..."):
+                        for chapter_name in chapter_names:
+                            cl.display_files_and_save_to_database(
+                                ebook_title, chapter_name
+                            )
                     st.experimental_rerun()
 
                 delete_ebook_button = st.button(f"Delete {delete_this_book}")
                 if delete_ebook_button:
                     db.delete_ebook(delete_this_book)
                     st.warning(f"{delete_this_book} deleted!")
-                    st.cache_data.clear()
                     st.experimental_rerun()
 
             # Display all the already written chapters
-            selected_ebook = db.db_ebook.get(ebook_title)
+            selected_ebook = db.load_ebook(ebook_title)
             chapters = []
             try:
                 for key, value in selected_ebook.items():
@@ -235,31 +254,32 @@ if st.session_state.authentication_status:
                             # Display all the chapter images with 2 columns
                             urls = db.get_chapter_art(ebook_title, chapter)
                             if urls:
-                                deleted_chapter_url = urls[:]
+                                thumbs = db.get_chapter_thumbs(ebook_title, chapter)
                                 col1, col2 = st.columns(2)  # Create two columns
-                                for j, cover_url in enumerate(urls):
-                                    # Extract the caption from the image_url
-                                    match = re.search(r"_(\w+)_\d+\.png", cover_url)
-                                    caption = match.group(1) if match else ""
-
+                                for j, (cover_url, thumb_url) in enumerate(
+                                    zip(urls, thumbs)
+                                ):
                                     # Determine the column to display the image based on the index
                                     column = col1 if j % 2 == 0 else col2
 
-                                    # Display the image with the extracted caption
+                                    # Display the thumbnail, the original on demand
                                     with column:
-                                        st.image(cover_url, caption=caption)
+                                        db.show_image(
+                                            cover_url,
+                                            thumb_url,
+                                            key=f"{ebook_title}_{chapter}_full_{j}",
+                                        )
                                         delete_chapter_url_button = st.button(
                                             f"Delete {chapter}_{j} Art",
                                         )
                                         if delete_chapter_url_button:
-                                            deleted_chapter_url.remove(cover_url)
                                             db.insert_ebook_art(
                                                 ebook_title,
                                                 chapter,
-                                                deleted_chapter_url,
+                                                urls[:j] + urls[j + 1 :],
+                                                thumbs[:j] + thumbs[j + 1 :],
                                             )
                                             st.warning(f"Chapter Art {j} deleted!")
-                                            st.cache_data.clear()
                                             st.experimental_rerun()
 
                             # Display chapter arts
@@ -278,20 +298,16 @@ if st.session_state.authentication_status:
                             if chapter_art_button:
                                 chapter_prompt = wr.get_ebook_prompt(value)
                                 neg_prompt = ar.get_negative_prompt(chapter_prompt)
-                                dalle_image = ar.create_dalle_image(
-                                    chapter_prompt,
-                                    st.session_state.samples,
-                                    dalle_num=False,
-                                )
-                                stable_image = ar.create_stable_image(
+                                dalle_image, stable_image = ar.create_images(
                                     chapter_prompt,
                                     st.session_state.width,
                                     st.session_state.height,
                                     st.session_state.engine,
                                     st.session_state.samples,
                                     st.session_state.steps,
+                                    dalle_num=False,
                                 )
-                                # Save Chapter images to the cloud storage
+                                # Save Chapter images to the cloud storage and database
                                 ar.save_chapter_img(
                                     ebook_title,
                                     chapter,
@@ -300,14 +316,10 @@ if st.session_state.authentication_status:
                                     dalle_num=False,
                                 )
 
-                                # Save cthe Chapter prompt and image urls to database
+                                # Save the Chapter prompt to database
                                 db.insert_image_prompt(
                                     ebook_title, chapter, chapter_prompt, neg_prompt
                                 )
-                                cl.display_files_and_save_to_database(
-                                    ebook_title, chapter
-                                )
-                                st.cache_data.clear()
                                 st.experimental_rerun()
                             delete_chapter_button = st.button(f"Delete {chapter}")
                             if delete_chapter_button:
@@ -315,11 +327,10 @@ if st.session_state.authentication_status:
                                     ebook_title, delete_this, "deleted"
                                 )
                                 st.warning(f"{chapter} deleted!")
-                                st.cache_data.clear()
                                 st.experimental_rerun()
 
             except Exception as e:
-                st.cache_data.clear()
+                db.invalidate_ebook(ebook_title)
                 st.experimental_rerun()
 
         # Insert form to write new chapter
@@ -331,6 +342,9 @@ if st.session_state.authentication_status:
             manuscript_button = st.form_submit_button(
                 f"Create Manuscript for {ebook_title}"
             )
+            all_chapters_button = st.form_submit_button(
+                f"Write All Chapters of {ebook_title}"
+            )
             if chapter_input_button:
                 st.info(f"Writing the chapter...")
                 target_audience = db.get_target_audience(ebook_title)
@@ -340,20 +354,23 @@ if st.session_state.authentication_status:
                 while available_chapter in used_chapters:
                     available_chapter += 1
 
-                write_new_chapter = wr.write_chapter(
-                    ebook_title,
-                    available_chapter,
-                    chapter_input,
-                    target_audience,
+                write_new_chapter = render_stream(
+                    wr.stream_chapter(
+                        ebook_title,
+                        available_chapter,
+                        chapter_input,
+                        target_audience,
+                    )
                 )
 
                 st.success(f"Chapter {len(chapters) + 1} written!")
-                st.cache_data.clear()
                 st.experimental_rerun()
             if manuscript_button:
                 st.info(f"Writing the Manuscript...")
                 target_audience = db.get_target_audience(ebook_title)
-                script = wr.manuscript(current_table_of_content, target_audience)
+                script = render_stream(
+                    wr.stream_manuscript(current_table_of_content, target_audience)
+                )
 
                 # Find the first available chapter number
                 available_chapter = 1
@@ -364,5 +381,50 @@ if st.session_state.authentication_status:
                 # Save chapter to database
                 db.insert_ebook_chapter(ebook_title, available_chapter, script)
                 st.success(f"Manuscript Created!")
-                st.cache_data.clear()
                 st.experimental_rerun()
+            if all_chapters_button:
+                target_audience = db.get_target_audience(ebook_title)
+                sections = wr.split_table_of_content(current_table_of_content or "")
+                # Sections a previous run drafted are skipped, so a failed run
+                # resumes without touching manuscripts or deleted chapters
+                written = db.get_batch_written(ebook_title)
+                remaining = len(
+                    [
+                        section_nro
+                        for section_nro in range(1, len(sections) + 1)
+                        if section_nro not in written
+                    ]
+                )
+                if not remaining:
+                    st.warning("No chapters left to write in the Table of Content.")
+                else:
+                    st.info(f"Writing {remaining} chapters...")
+                    progress = st.progress(0.0)
+                    failed = []
+                    for done, (section_nro, chapter_nro, error) in enumerate(
+                        wr.write_chapters(
+                            ebook_title,
+                            sections,
+                            target_audience,
+                            written,
+                            db.get_chapter_numbers(ebook_title),
+                        ),
+                        start=1,
+                    ):
+                        progress.progress(
+                            done / remaining, text=f"{done}/{remaining} chapters"
+                        )
+                        if error:
+                            failed.append(section_nro)
+                            st.error(f"Section {section_nro} failed: {error}")
+                        else:
+                            st.success(
+                                f"Section {section_nro} written as Chapter {chapter_nro}!"
+                            )
+
+                    if failed:
+                        st.warning(
+                            f"{len(failed)} chapters failed, submit again to resume."
+                        )
+                    else:
+                        st.experimental_rerun()
@@ -3,6 +3,11 @@ from streamlit_extras.add_vertical_space import add_vertical_space
 import _mixer as mix
 
 
+# Shorter inputs are not searched, and the width the album covers are shown at
+MIN_QUERY_LENGTH = 3
+IMAGE_WIDTH = 160
+
+
 TITLE = "Spoti Mixer"
 ABOUT = """
         🎵 Spoty GPT
@@ -42,13 +47,29 @@ if st.session_state.authentication_status:
 
     with tab1:
         st.title("Music Recommendation System")
-        track_name = st.text_input("Enter a song name:")
-        if track_name:
-            recommendations = mix.get_recommendations(track_name)
-            st.write("Recommended songs:")
+        track_name = st.text_input("Enter a song name:").strip()
+        if "last_track_search" not in st.session_state:
+            st.session_state.last_track_search = ""
+            st.session_state.last_recommendations = []
+        if len(track_name) >= MIN_QUERY_LENGTH:
+            # Only a changed search goes to the service, reruns from the other
+            # widgets reuse the recommendations already shown
+            if track_name != st.session_state.last_track_search:
+                with st.spinner("Finding recommendations..."):
+                    st.session_state.last_recommendations = mix.get_recommendations(
+                        track_name
+                    )
+                st.session_state.last_track_search = track_name
+            recommendations = st.session_state.last_recommendations
+            if not recommendations:
+                st.info(f"No song found for {track_name}")
+            else:
+                st.write("Recommended songs:")
             for track in recommendations:
                 st.write(track["name"])
-                st.image(track["album"]["images"][0]["url"])
+                image_url = mix.pick_image(track["album"]["images"], IMAGE_WIDTH)
+                if image_url:
+                    st.image(image_url, width=IMAGE_WIDTH)
 
     with tab2:
         popularity = st.sidebar.slider("Song Popularity", 1, 30, 10, 1)